@@ -46,6 +46,7 @@ whisper = _cfg.get("whisper", {})
 proxy = _cfg.get("proxy", {})
 azure = _cfg.get("azure", {})
 ui = _cfg.get("ui", {})
+encoding_profiles = _cfg.get("encoding_profiles", {})
 
 hostname = socket.gethostname()
 
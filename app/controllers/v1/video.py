@@ -19,6 +19,7 @@ from app.models.schema import (
     AudioRequest,
     BgmRetrieveResponse,
     BgmUploadResponse,
+    CacheStatsResponse,
     SubtitleRequest,
     TaskDeletionResponse,
     TaskQueryRequest,
@@ -26,6 +27,7 @@ from app.models.schema import (
     TaskResponse,
     TaskVideoRequest,
 )
+from app.services import manifest, material, voice
 from app.services import state as sm
 from app.services import task as tm
 from app.utils import utils
@@ -58,6 +60,57 @@ def create_video(
     return create_task(request, body, stop_at="video")
 
 
+@router.post(
+    "/videos/{task_id}/final",
+    response_model=TaskResponse,
+    summary="Render the final video of a previewed task",
+)
+def create_final_video(
+    background_tasks: BackgroundTasks,
+    request: Request,
+    body: TaskVideoRequest,
+    task_id: str = Path(..., description="Task ID"),
+):
+    request_id = base.get_task_id(request)
+    task = sm.state.get_task(task_id)
+    if not task:
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+
+    task_manager.add_task(tm.render_final, task_id=task_id, params=body)
+    task = {
+        "task_id": task_id,
+        "request_id": request_id,
+        "params": body.model_dump(),
+    }
+    logger.success(f"Final render created: {utils.to_json(task)}")
+    return utils.get_response(200, task)
+
+
+@router.post(
+    "/videos/{task_id}/resume",
+    response_model=TaskResponse,
+    summary="Resume a failed task, skipping the stages that already finished",
+)
+def resume_video(
+    background_tasks: BackgroundTasks,
+    request: Request,
+    task_id: str = Path(..., description="Task ID"),
+):
+    request_id = base.get_task_id(request)
+    if not os.path.isfile(manifest.manifest_file(task_id)):
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+
+    sm.state.update_task(task_id)
+    task_manager.add_task(tm.resume_task, task_id=task_id)
+    task = {"task_id": task_id, "request_id": request_id}
+    logger.success(f"Task resumed: {utils.to_json(task)}")
+    return utils.get_response(200, task)
+
+
 @router.post("/subtitle", response_model=TaskResponse, summary="Generate subtitle only")
 def create_subtitle(
     background_tasks: BackgroundTasks, request: Request, body: SubtitleRequest
@@ -115,7 +168,7 @@ def get_task(
 
         def file_to_uri(file):
             if not file.startswith(endpoint):
-                _uri_path = v.replace(task_dir, "tasks").replace("\\", "/")
+                _uri_path = file.replace(task_dir, "tasks").replace("\\", "/")
                 _uri_path = f"{endpoint}/{_uri_path}"
             else:
                 _uri_path = file
@@ -133,6 +186,8 @@ def get_task(
             for v in combined_videos:
                 urls.append(file_to_uri(v))
             task["combined_videos"] = urls
+        if "preview_videos" in task:
+            task["preview_videos"] = [file_to_uri(v) for v in task["preview_videos"]]
         return utils.get_response(200, task)
 
     raise HttpException(
@@ -207,6 +262,19 @@ def upload_bgm_file(request: Request, file: UploadFile = File(...)):
     )
 
 
+@router.get(
+    "/cache/stats",
+    response_model=CacheStatsResponse,
+    summary="Hit and miss counts of the caches since the service started",
+)
+def get_cache_stats(request: Request):
+    response = {
+        "search": material.get_search_cache_stats(),
+        "tts": voice.get_tts_cache_stats(),
+    }
+    return utils.get_response(200, response)
+
+
 @router.get("/stream/{file_path:path}")
 async def stream_video(request: Request, file_path: str):
     tasks_dir = utils.task_dir()
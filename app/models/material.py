@@ -15,6 +15,7 @@ class MaterialInfo:
     duration: float = 0.0
     prompt: str = ""  # For AI-generated images
     sentence: str = ""  # Original sentence that generated this material
+    thumbnail: str = ""  # Preview image of a stock video
     
     def __init__(
         self,
@@ -23,11 +24,13 @@ class MaterialInfo:
         url: str = "",
         duration: float = 0.0,
         prompt: str = "",
-        sentence: str = ""
+        sentence: str = "",
+        thumbnail: str = ""
     ):
         self.type = type
         self.provider = provider
         self.url = url
         self.duration = duration
         self.prompt = prompt
-        self.sentence = sentence 
\ No newline at end of file
+        self.sentence = sentence
+        self.thumbnail = thumbnail 
\ No newline at end of file
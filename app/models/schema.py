@@ -27,6 +27,17 @@ class VideoTransitionMode(str, Enum):
     slide_out = "SlideOut"
 
 
+class RenderBackend(str, Enum):
+    moviepy = "moviepy"
+    ffmpeg = "ffmpeg"
+
+
+class RenderMode(str, Enum):
+    # low resolution / low fps draft to check cuts, subtitles and transitions
+    preview = "preview"
+    final = "final"
+
+
 class VideoAspect(str, Enum):
     landscape = "16:9"
     portrait = "9:16"
@@ -78,6 +89,8 @@ class VideoParams(BaseModel):
     video_count: Optional[int] = 1
 
     video_source: Optional[str] = "pexels"
+    # search Pexels and Pixabay together, whatever the video source
+    search_all_providers: Optional[bool] = False
     video_materials: Optional[List[MaterialInfo]] = (
         None  # Materials used to generate the video
     )
@@ -104,6 +117,28 @@ class VideoParams(BaseModel):
     n_threads: Optional[int] = 2
     paragraph_number: Optional[int] = 1
 
+    # Encode the timeline, subtitles and audio in one pass
+    single_pass_render: Optional[bool] = True
+    # Also write combined-N.mp4 (the timeline without subtitles and audio)
+    save_combined_video: Optional[bool] = False
+    # moviepy: composite frames in python, ffmpeg: one filter_complex graph
+    render_backend: Optional[RenderBackend] = RenderBackend.moviepy.value
+    # > 1: render the clips as separate segments in parallel worker processes
+    render_workers: Optional[int] = 1
+    # draft / standard / archive, or a table under [encoding_profiles] in config.toml
+    encoding_profile: Optional[str] = "standard"
+    # per task overrides of the encoding profile
+    video_preset: Optional[str] = None  # x264 preset, e.g. ultrafast, medium, slow
+    video_crf: Optional[int] = None
+    video_tune: Optional[str] = None
+    video_gop: Optional[int] = None  # keyframe interval in frames
+    video_pix_fmt: Optional[str] = None
+    audio_bitrate: Optional[str] = None  # e.g. 128k
+    # preview renders preview-N.mp4 at 360p / 15fps with the draft profile
+    render_mode: Optional[RenderMode] = RenderMode.final.value
+    # seed of the random timeline, the same seed and materials give the same cuts
+    video_seed: Optional[int] = None
+
 
 class SubtitleRequest(BaseModel):
     video_script: str
@@ -292,6 +327,20 @@ class BgmRetrieveResponse(BaseResponse):
         }
 
 
+class CacheStatsResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "search": {"hits": 12, "misses": 4, "hit_rate": 0.75},
+                    "tts": {"hits": 3, "misses": 1, "hit_rate": 0.75},
+                },
+            },
+        }
+
+
 class BgmUploadResponse(BaseResponse):
     class Config:
         json_schema_extra = {
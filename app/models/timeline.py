@@ -0,0 +1,77 @@
+import json
+from dataclasses import asdict, dataclass, field, replace
+from typing import List, Optional
+
+
+@dataclass
+class TimelineClip:
+    """One cut of the timeline: which slice of which source, where and how it is drawn"""
+
+    path: str
+    start: float  # in point in the source, seconds
+    end: float  # out point in the source, seconds
+    duration: float  # time on the timeline, longer than end - start when looped
+    loops: int = 1
+    # source stream, used to decide if the slice can be stream copied
+    width: int = 0
+    height: int = 0
+    fps: float = 0.0
+    codec: str = ""
+    pix_fmt: str = ""
+    # scaled size and position inside the frame, the rest is black
+    scaled_width: int = 0
+    scaled_height: int = 0
+    x: int = 0
+    y: int = 0
+    transition: Optional[str] = None  # VideoTransitionMode value
+    side: str = "left"  # slide direction
+
+
+@dataclass
+class Timeline:
+    """
+    All the decisions of a render: the cuts, their geometry and transitions.
+    Rendering is a pure function of the timeline, so it can be saved next to
+    the video, cached, resumed or re-rendered.
+    """
+
+    width: int
+    height: int
+    fps: int = 30
+    seed: Optional[int] = None
+    clips: List[TimelineClip] = field(default_factory=list)
+    version: int = 1
+
+    @property
+    def duration(self) -> float:
+        return sum(clip.duration for clip in self.clips)
+
+    def offsets(self) -> List[float]:
+        """Start time of every clip on the timeline"""
+        offsets = []
+        offset = 0.0
+        for clip in self.clips:
+            offsets.append(offset)
+            offset += clip.duration
+        return offsets
+
+    def with_clips(self, clips: List[TimelineClip]) -> "Timeline":
+        return replace(self, clips=list(clips))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Timeline":
+        data = dict(data)
+        data["clips"] = [TimelineClip(**clip) for clip in data.get("clips", [])]
+        return cls(**data)
+
+    def save(self, file_path: str):
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, file_path: str) -> "Timeline":
+        with open(file_path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
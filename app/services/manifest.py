@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from app.utils import utils
+
+# bump when the layout of the stage outputs changes, older manifests are ignored
+MANIFEST_VERSION = 1
+
+# stages of a task can finish concurrently
+_lock = threading.Lock()
+
+
+def manifest_file(task_id: str) -> str:
+    return os.path.join(utils.task_dir(task_id), "manifest.json")
+
+
+def load(task_id: str) -> dict:
+    file_path = manifest_file(task_id)
+    if not os.path.isfile(file_path):
+        return {}
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        logger.warning(f"invalid task manifest: {file_path}, {str(e)}")
+        return {}
+    if data.get("version") != MANIFEST_VERSION:
+        return {}
+    return data
+
+
+def _save(task_id: str, data: dict):
+    data["version"] = MANIFEST_VERSION
+    file_path = manifest_file(task_id)
+    tmp_file = f"{file_path}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_file, file_path)
+
+
+def save_task(task_id: str, params, stop_at: str):
+    """Record what the task was started with, so it can be resumed later"""
+    with _lock:
+        data = load(task_id)
+        data["params"] = params.model_dump(mode="json", warnings=False)
+        data["stop_at"] = stop_at
+        _save(task_id, data)
+
+
+def stage_key(*inputs) -> str:
+    """
+    Hash of the inputs of a stage. Pass the key of the stage it depends on
+    as one of the inputs, so a change invalidates every stage after it.
+    """
+    return utils.md5(json.dumps(inputs, sort_keys=True, default=str))
+
+
+def get_stage(task_id: str, stage: str, key: str) -> Optional[dict]:
+    """
+    Outputs of a finished stage whose inputs hash to key, None when the stage
+    has to run again: it never ran, its inputs changed or a file it produced
+    is gone.
+    """
+    entry = load(task_id).get("stages", {}).get(stage)
+    if not entry or entry.get("key") != key:
+        return None
+    for file_path in entry.get("files", []):
+        if not os.path.isfile(file_path):
+            logger.info(f"stage {stage} output is missing: {file_path}")
+            return None
+    logger.info(f"stage {stage} is unchanged, reusing its outputs")
+    return entry.get("outputs", {})
+
+
+def save_stage(task_id: str, stage: str, key: str, outputs: dict, files: List[str] = None):
+    with _lock:
+        data = load(task_id)
+        data.setdefault("stages", {})[stage] = {
+            "key": key,
+            "outputs": outputs,
+            "files": [f for f in files or [] if f],
+            "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        _save(task_id, data)
@@ -1,11 +1,18 @@
+import asyncio
+import io
+import json
 import os
 import random
-from typing import List, Optional
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Optional, Union
 from urllib.parse import urlencode
 
 import requests
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
+from PIL import Image
 
 from app.config import config
 from app.models.schema import VideoAspect, VideoConcatMode
@@ -14,9 +21,33 @@ from app.utils import utils
 from app.services.midjourney.prompt import PromptGenerator
 from app.services.midjourney.client import ImageGenerationClient
 from app.services.llm import get_llm_client
+from app.services import material_index
+from app.services.video_processing import ffmpeg_utils
+from app.services.video_processing.encoding import (
+    ffmpeg_video_args,
+    get_normalized_profile,
+)
 
 requested_count = 0
 
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    """One connection pool shared by all the downloads"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session.headers["User-Agent"] = (
+                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+            )
+        return _session
+
 
 def get_api_key(cfg_key: str):
     api_keys = config.app.get(cfg_key)
@@ -35,11 +66,99 @@ def get_api_key(cfg_key: str):
     return api_keys[requested_count % len(api_keys)]
 
 
+_search_stats = {"hits": 0, "misses": 0}
+_search_stats_lock = threading.Lock()
+
+
+def _count_search(hit: bool):
+    with _search_stats_lock:
+        _search_stats["hits" if hit else "misses"] += 1
+
+
+def get_search_cache_stats() -> dict:
+    with _search_stats_lock:
+        stats = dict(_search_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 3) if total else 0.0
+    return stats
+
+
+def _search_cache_file(
+    provider: str, search_term: str, minimum_duration: int, video_aspect
+) -> str:
+    # the api key is not part of the key, every key returns the same results
+    key = utils.md5(
+        json.dumps(
+            [
+                provider,
+                " ".join(search_term.lower().split()),
+                minimum_duration,
+                VideoAspect(video_aspect).value,
+            ]
+        )
+    )
+    return os.path.join(utils.storage_dir("cache_search", create=True), f"{key}.json")
+
+
+def _get_cached_search(cache_file: str) -> Optional[List[MaterialInfo]]:
+    ttl = float(config.app.get("search_cache_ttl_hours", 24)) * 3600
+    if ttl <= 0 or not os.path.isfile(cache_file):
+        _count_search(False)
+        return None
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if time.time() - data["created_at"] < ttl:
+            _count_search(True)
+            logger.info(f"search results from cache: {cache_file}")
+            return [
+                MaterialInfo(
+                    type=MaterialType.VIDEO,
+                    provider=item["provider"],
+                    url=item["url"],
+                    duration=item["duration"],
+                    thumbnail=item.get("thumbnail", ""),
+                )
+                for item in data["items"]
+            ]
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"invalid search cache file: {cache_file} => {str(e)}")
+    _count_search(False)
+    return None
+
+
+def _save_search(cache_file: str, video_items: List[MaterialInfo]):
+    data = {
+        "created_at": time.time(),
+        "items": [
+            {
+                "provider": item.provider,
+                "url": item.url,
+                "duration": item.duration,
+                "thumbnail": item.thumbnail,
+            }
+            for item in video_items
+        ],
+    }
+    temp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_file, cache_file)
+    except OSError as e:
+        logger.warning(f"failed to save search results: {str(e)}")
+
+
 def search_videos_pexels(
     search_term: str,
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
 ) -> List[MaterialInfo]:
+    cache_file = _search_cache_file("pexels", search_term, minimum_duration, video_aspect)
+    cached_items = _get_cached_search(cache_file)
+    if cached_items is not None:
+        return cached_items
+
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
     video_width, video_height = aspect.to_resolution()
@@ -83,10 +202,12 @@ def search_videos_pexels(
                         type=MaterialType.VIDEO,
                         provider="pexels",
                         url=video["link"],
-                        duration=duration
+                        duration=duration,
+                        thumbnail=v.get("image", ""),
                     )
                     video_items.append(item)
                     break
+        _save_search(cache_file, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -99,6 +220,11 @@ def search_videos_pixabay(
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
 ) -> List[MaterialInfo]:
+    cache_file = _search_cache_file("pixabay", search_term, minimum_duration, video_aspect)
+    cached_items = _get_cached_search(cache_file)
+    if cached_items is not None:
+        return cached_items
+
     aspect = VideoAspect(video_aspect)
     video_width, video_height = aspect.to_resolution()
     api_key = get_api_key("pixabay_api_keys")
@@ -139,10 +265,12 @@ def search_videos_pixabay(
                         type=MaterialType.VIDEO,
                         provider="pixabay",
                         url=video["url"],
-                        duration=duration
+                        duration=duration,
+                        thumbnail=video.get("thumbnail", ""),
                     )
                     video_items.append(item)
                     break
+        _save_search(cache_file, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -150,54 +278,267 @@ def search_videos_pixabay(
     return []
 
 
-def save_video(video_url: str, save_dir: str = "") -> str:
+def save_video(
+    video_url: str,
+    save_dir: str = "",
+    provider: str = "",
+    search_term: str = "",
+    video_aspect: str = "",
+) -> str:
+    """
+    Download a video into save_dir once, and record it in the material index
+    of the dir with the search term it was found with.
+    """
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
 
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    url_without_query = video_url.split("?")[0]
-    url_hash = utils.md5(url_without_query)
+    url_hash = material_index.url_hash(video_url)
     video_id = f"vid-{url_hash}"
     video_path = f"{save_dir}/{video_id}.mp4"
 
+    def _index(info: dict):
+        material_index.record(
+            save_dir,
+            url_hash,
+            video_url,
+            video_path,
+            info,
+            provider=provider,
+            search_term=search_term,
+            video_aspect=video_aspect,
+        )
+
     # if video already exists, return the path
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-        logger.info(f"video already exists: {video_path}")
+        info = ffmpeg_utils.get_video_info(video_path)
+        if ffmpeg_utils.is_valid_video(info):
+            logger.info(f"video already exists: {video_path}")
+            _index(info)
+            return video_path
+        logger.warning(f"invalid cached video, downloading it again: {video_path}")
+
+    # stream into a temp file next to the target, so memory stays flat and a
+    # partial download never shows up as a cached video
+    fd, temp_path = tempfile.mkstemp(prefix=f"{video_id}-", suffix=".part", dir=save_dir)
+    try:
+        with os.fdopen(fd, "wb") as f, _get_session().get(
+            video_url,
+            proxies=config.proxy,
+            verify=False,
+            timeout=(60, 240),
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+
+        if os.path.getsize(temp_path) > 0:
+            info = ffmpeg_utils.probe_video(temp_path)
+            if ffmpeg_utils.is_valid_video(info):
+                os.replace(temp_path, video_path)
+                ffmpeg_utils.save_video_info(video_path, info)
+                _index(info)
+                return video_path
+            logger.warning(f"invalid video file: {video_url}")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return ""
+
+
+def _normalized_cache_key(video_path: str) -> str:
+    # downloaded clips are already named after the url hash
+    video_id = os.path.splitext(os.path.basename(video_path))[0]
+    if video_id.startswith("vid-"):
+        return video_id
+
+    stat = os.stat(video_path)
+    return "vid-" + utils.md5(
+        f"{os.path.abspath(video_path)}:{stat.st_size}:{stat.st_mtime}"
+    )
+
+
+def normalize_video(
+    video_path: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    fps: int = 30,
+    codec: str = "h264",
+    save_dir: str = "",
+) -> str:
+    """
+    Transcode a clip once into the canonical render format (target resolution,
+    letterboxed, fixed fps and a one second GOP) so later tasks can use it
+    without any per-frame resize work, and its cuts can be stream copied.
+    """
+    if not save_dir:
+        save_dir = utils.storage_dir(
+            os.path.join("cache_videos", "normalized"), create=True
+        )
+
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    video_id = _normalized_cache_key(video_path)
+    normalized_path = os.path.join(
+        save_dir, f"{video_id}-{video_width}x{video_height}-{fps}fps-{codec}.mp4"
+    )
+
+    if os.path.exists(normalized_path) and os.path.getsize(normalized_path) > 0:
+        logger.info(f"normalized video already exists: {normalized_path}")
+        utils.touch_file(normalized_path)
+        return normalized_path
+
+    info = ffmpeg_utils.get_video_info(video_path)
+    if (
+        info["codec"] == codec
+        and info["pix_fmt"] == "yuv420p"
+        and (info["width"], info["height"]) == (video_width, video_height)
+        and abs(info["fps"] - fps) < 0.01
+    ):
         return video_path
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
-    }
+    temp_path = f"{normalized_path}.{utils.get_uuid(True)}.mp4"
+    try:
+        ffmpeg_utils.run_ffmpeg(
+            [
+                "-i",
+                video_path,
+                "-an",
+                "-vf",
+                f"fps={fps},"
+                f"scale={video_width}:{video_height}:force_original_aspect_ratio=decrease,"
+                f"pad={video_width}:{video_height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+                "setsar=1,format=yuv420p",
+                *ffmpeg_video_args(get_normalized_profile(fps), fps, 0),
+                "-movflags",
+                "+faststart",
+                temp_path,
+            ]
+        )
+        os.replace(temp_path, normalized_path)
+    except Exception as e:
+        logger.warning(f"failed to normalize video: {video_path} => {str(e)}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return video_path
+
+    max_size = int(config.app.get("normalized_cache_max_size_mb", 10240)) * 1024 * 1024
+    utils.evict_lru_files(
+        save_dir, max_size, suffix=".mp4", sidecar_suffix=ffmpeg_utils.META_SUFFIX
+    )
+    logger.info(f"video normalized: {normalized_path}")
+    return normalized_path
 
-    # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url,
-                headers=headers,
-                proxies=config.proxy,
-                verify=False,
-                timeout=(60, 240),
-            ).content
+
+def normalize_videos(
+    video_paths: List[str], video_aspect: VideoAspect = VideoAspect.portrait
+) -> List[str]:
+    if not config.app.get("normalize_materials", False):
+        return video_paths
+    return [normalize_video(p, video_aspect=video_aspect) for p in video_paths]
+
+
+def _thumbnail_hash(thumbnail_url: str) -> Optional[int]:
+    """64 bit difference hash of a preview image, close hashes are the same shot"""
+    try:
+        r = _get_session().get(
+            thumbnail_url, proxies=config.proxy, verify=False, timeout=(10, 30)
         )
+        r.raise_for_status()
+        image = Image.open(io.BytesIO(r.content)).convert("L")
+        image = image.resize((9, 8), Image.Resampling.LANCZOS)
+    except Exception as e:
+        logger.debug(f"failed to load thumbnail: {thumbnail_url} => {str(e)}")
+        return None
+
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            value = value << 1 | (left > right)
+    return value
 
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-        try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
-                return video_path
-        except Exception as e:
-            try:
-                os.remove(video_path)
-            except Exception:
-                pass
-            logger.warning(f"invalid video file: {video_path} => {str(e)}")
-    return ""
+
+def remove_similar_videos(
+    video_items: List[MaterialInfo], max_distance: int = 6
+) -> List[MaterialInfo]:
+    """
+    Drop the videos another provider also returned: the same stock clip is
+    often on both Pexels and Pixabay under a different url. Only videos of
+    about the same duration from different providers are compared, so few
+    thumbnails are fetched.
+    """
+    pairs = [
+        (a, b)
+        for i, a in enumerate(video_items)
+        for b in video_items[i + 1 :]
+        if a.provider != b.provider
+        and a.thumbnail
+        and b.thumbnail
+        and abs(a.duration - b.duration) <= 1
+    ]
+    if not pairs:
+        return video_items
+
+    thumbnails = list({item.thumbnail for pair in pairs for item in pair})
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        hashes = dict(zip(thumbnails, executor.map(_thumbnail_hash, thumbnails)))
+
+    duplicates = set()
+    for a, b in pairs:
+        if a.url in duplicates:
+            continue
+        hash_a, hash_b = hashes[a.thumbnail], hashes[b.thumbnail]
+        if hash_a is None or hash_b is None:
+            continue
+        if bin(hash_a ^ hash_b).count("1") <= max_distance:
+            duplicates.add(b.url)
+
+    if duplicates:
+        logger.info(f"removed {len(duplicates)} videos found on both providers")
+    return [item for item in video_items if item.url not in duplicates]
+
+
+class DurationTarget:
+    """
+    Duration of footage to download when the audio is still being generated:
+    an estimate at first, final once the real audio duration is set.
+    """
+
+    def __init__(self, estimate: float):
+        self.value = estimate
+        self._final = threading.Event()
+        self._lock = threading.Lock()
+
+    def update(self, estimate: float):
+        """Refine the estimate while the audio is generated"""
+        with self._lock:
+            if not self._final.is_set():
+                self.value = estimate
+
+    def set(self, duration: float):
+        with self._lock:
+            self.value = duration
+            self._final.set()
+
+    def is_final(self) -> bool:
+        return self._final.is_set()
+
+    def reached(self, duration: float) -> bool:
+        """True when duration covers the target, waits for the final value if needed"""
+        if duration <= self.value:
+            return False
+        if not self._final.is_set():
+            logger.info(
+                f"downloaded {duration} seconds, the estimated duration, waiting for the audio"
+            )
+            self._final.wait()
+        return duration > self.value
+
+    def __str__(self):
+        return f"{self.value}" if self.is_final() else f"~{self.value:.1f}"
 
 
 def download_videos(
@@ -206,63 +547,152 @@ def download_videos(
     source: str = "pexels",
     video_aspect: VideoAspect = VideoAspect.portrait,
     video_contact_mode: VideoConcatMode = VideoConcatMode.random,
-    audio_duration: float = 0.0,
+    audio_duration: Union[float, DurationTarget] = 0.0,
     max_clip_duration: int = 5,
+    all_providers: bool = False,
 ) -> List[str]:
-    valid_video_items = []
-    valid_video_urls = []
-    found_duration = 0.0
-    search_videos = search_videos_pexels
-    if source == "pixabay":
-        search_videos = search_videos_pixabay
-
-    for search_term in search_terms:
-        video_items = search_videos(
-            search_term=search_term,
-            minimum_duration=max_clip_duration,
-            video_aspect=video_aspect,
-        )
-        logger.info(f"found {len(video_items)} videos for '{search_term}'")
-
-        for item in video_items:
-            if item.url not in valid_video_urls:
-                valid_video_items.append(item)
-                valid_video_urls.append(item.url)
-                found_duration += item.duration
-
-    logger.info(
-        f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
-    )
-    video_paths = []
+    if not isinstance(audio_duration, DurationTarget):
+        target = DurationTarget(audio_duration)
+        target.set(audio_duration)
+        audio_duration = target
 
+    aspect = VideoAspect(video_aspect).value
     material_directory = config.app.get("material_directory", "").strip()
+    # task dirs are not shared, their videos are never reused
+    use_index = material_directory != "task"
     if material_directory == "task":
         material_directory = utils.task_dir(task_id)
     elif material_directory and not os.path.isdir(material_directory):
         material_directory = ""
 
-    if video_contact_mode.value == VideoConcatMode.random.value:
-        random.shuffle(valid_video_items)
+    valid_video_items = []
+    item_terms = {}
+    if all_providers:
+        providers = [search_videos_pexels, search_videos_pixabay]
+    elif source == "pixabay":
+        providers = [search_videos_pixabay]
+    else:
+        providers = [search_videos_pexels]
+
+    def _add_items(video_items: List[MaterialInfo], search_term: str):
+        for item in video_items:
+            if item.url not in item_terms:
+                valid_video_items.append(item)
+                item_terms[item.url] = search_term
+
+    def _shuffle_from(start: int):
+        if video_contact_mode.value == VideoConcatMode.random.value:
+            new_items = valid_video_items[start:]
+            random.shuffle(new_items)
+            valid_video_items[start:] = new_items
+
+    def _search():
+        # every term on every provider at once, merged in the order of the terms
+        start = len(valid_video_items)
+        found_duration = 0.0
+        queries = [(term, search) for term in search_terms for search in providers]
+        with ThreadPoolExecutor(max_workers=min(len(queries), 8) or 1) as executor:
+            results = executor.map(
+                lambda query: query[1](
+                    search_term=query[0],
+                    minimum_duration=max_clip_duration,
+                    video_aspect=video_aspect,
+                ),
+                queries,
+            )
+            for (search_term, _), video_items in zip(queries, results):
+                logger.info(f"found {len(video_items)} videos for '{search_term}'")
+                _add_items(video_items, search_term)
+                found_duration += sum(item.duration for item in video_items)
+        if all_providers:
+            valid_video_items[start:] = remove_similar_videos(valid_video_items[start:])
+        _shuffle_from(start)
+        logger.info(
+            f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
+        )
 
-    total_duration = 0.0
-    for item in valid_video_items:
+    # videos downloaded earlier for the same terms come first, the stock
+    # footage APIs are only called when they do not cover the audio
+    searched = False
+    cached_duration = 0.0
+    if use_index:
+        index_dir = material_directory or utils.storage_dir("cache_videos")
+        for search_term in search_terms:
+            _add_items(
+                material_index.find(index_dir, search_term, aspect, max_clip_duration),
+                search_term,
+            )
+        _shuffle_from(0)
+        cached_duration = sum(
+            min(max_clip_duration, item.duration) for item in valid_video_items
+        )
+        logger.info(
+            f"found {len(valid_video_items)} cached videos, {cached_duration} seconds"
+        )
+    if cached_duration <= audio_duration.value:
+        _search()
+        searched = True
+
+    def _download(item: MaterialInfo) -> str:
         try:
             logger.info(f"downloading video: {item.url}")
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory
+            return save_video(
+                video_url=item.url,
+                save_dir=material_directory,
+                provider=item.provider,
+                search_term=item_terms.get(item.url, ""),
+                video_aspect=aspect,
             )
-            if saved_video_path:
-                logger.info(f"video saved: {saved_video_path}")
-                video_paths.append(saved_video_path)
+        except Exception as e:
+            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+            return ""
+
+    # downloads are scheduled while the finished and the running ones do not
+    # cover the audio yet, a failed download makes room for the next video
+    workers = max(1, int(config.app.get("download_workers", 4)))
+    saved_videos = {}
+    running = {}
+    next_index = 0
+    total_duration = 0.0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            scheduled = total_duration + sum(seconds for _, seconds in running.values())
+            while (
+                next_index < len(valid_video_items)
+                and len(running) < workers
+                and scheduled <= audio_duration.value
+            ):
+                item = valid_video_items[next_index]
                 seconds = min(max_clip_duration, item.duration)
-                total_duration += seconds
-                if total_duration > audio_duration:
+                running[executor.submit(_download, item)] = (next_index, seconds)
+                scheduled += seconds
+                next_index += 1
+
+            if not running:
+                if audio_duration.reached(total_duration):
                     logger.info(
                         f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
                     )
                     break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+                if next_index >= len(valid_video_items):
+                    if searched:
+                        break
+                    # the cached videos do not cover the real audio duration
+                    _search()
+                    searched = True
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, seconds = running.pop(future)
+                saved_video_path = future.result()
+                if saved_video_path:
+                    logger.info(f"video saved: {saved_video_path}")
+                    saved_videos[index] = saved_video_path
+                    total_duration += seconds
+
+    # keep the order of the items, it matters for the sequential concat mode
+    video_paths = [saved_videos[index] for index in sorted(saved_videos)]
     logger.success(f"downloaded {len(video_paths)} videos")
     return video_paths
 
@@ -295,8 +725,11 @@ class MaterialService:
     ) -> List[MaterialInfo]:
         """Generate image materials from script using configured image provider"""
         try:
-            # Generate prompts for each sentence in script
-            prompt_results = self.prompt_generator.generate_prompts_for_script(script)
+            # Generate prompts for each sentence in script. The LLM and image
+            # clients block, run them off the shared loop so TTS keeps going
+            prompt_results = await asyncio.to_thread(
+                self.prompt_generator.generate_prompts_for_script, script
+            )
             
             materials = []
             os.makedirs(output_dir, exist_ok=True)
@@ -304,7 +737,9 @@ class MaterialService:
             for i, result in enumerate(prompt_results):
                 try:
                     # Generate image from prompt with specified aspect ratio
-                    image_data = self.image_client.generate_image(result['prompt'], video_aspect)
+                    image_data = await asyncio.to_thread(
+                        self.image_client.generate_image, result['prompt'], video_aspect
+                    )
                     
                     # Save image to file
                     image_path = os.path.join(output_dir, f"image_{i}.png")
@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import time
+from typing import List
+
+from loguru import logger
+
+from app.models.material import MaterialInfo, MaterialType
+from app.utils import utils
+
+INDEX_FILE = "materials.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    url_hash TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    path TEXT NOT NULL,
+    provider TEXT NOT NULL DEFAULT '',
+    duration REAL NOT NULL DEFAULT 0,
+    fps REAL NOT NULL DEFAULT 0,
+    width INTEGER NOT NULL DEFAULT 0,
+    height INTEGER NOT NULL DEFAULT 0,
+    codec TEXT NOT NULL DEFAULT '',
+    size INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT NOT NULL,
+    video_aspect TEXT NOT NULL,
+    url_hash TEXT NOT NULL,
+    PRIMARY KEY (term, video_aspect, url_hash)
+);
+"""
+
+
+def _connect(save_dir: str) -> sqlite3.Connection:
+    # a connection per call, downloads record their videos from several threads
+    conn = sqlite3.connect(os.path.join(save_dir, INDEX_FILE), timeout=30)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _normalize_term(term: str) -> str:
+    return " ".join(term.lower().split())
+
+
+def record(
+    save_dir: str,
+    url_hash: str,
+    video_url: str,
+    video_path: str,
+    info: dict,
+    provider: str = "",
+    search_term: str = "",
+    video_aspect: str = "",
+):
+    """Add or refresh a cached video and link it to the search term it was found with"""
+    now = time.time()
+    try:
+        with _connect(save_dir) as conn:
+            conn.execute(
+                """
+                INSERT INTO videos (url_hash, url, path, provider, duration, fps,
+                    width, height, codec, size, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url_hash) DO UPDATE SET
+                    path = excluded.path,
+                    provider = CASE WHEN excluded.provider != ''
+                        THEN excluded.provider ELSE videos.provider END,
+                    duration = excluded.duration, fps = excluded.fps,
+                    width = excluded.width, height = excluded.height,
+                    codec = excluded.codec, size = excluded.size,
+                    last_used = excluded.last_used
+                """,
+                (
+                    url_hash,
+                    video_url,
+                    video_path,
+                    provider,
+                    info.get("duration", 0),
+                    info.get("fps", 0),
+                    info.get("width", 0),
+                    info.get("height", 0),
+                    info.get("codec", ""),
+                    os.path.getsize(video_path),
+                    now,
+                    now,
+                ),
+            )
+            if search_term:
+                conn.execute(
+                    "INSERT OR IGNORE INTO terms (term, video_aspect, url_hash) VALUES (?, ?, ?)",
+                    (_normalize_term(search_term), video_aspect, url_hash),
+                )
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"failed to index video: {video_path} => {str(e)}")
+
+
+def find(
+    save_dir: str, search_term: str, video_aspect: str, minimum_duration: float
+) -> List[MaterialInfo]:
+    """Cached videos found earlier for search_term, most recently used first"""
+    if not os.path.isfile(os.path.join(save_dir, INDEX_FILE)):
+        return []
+    try:
+        with _connect(save_dir) as conn:
+            rows = conn.execute(
+                """
+                SELECT v.url, v.path, v.provider, v.duration FROM videos v
+                JOIN terms t ON t.url_hash = v.url_hash
+                WHERE t.term = ? AND t.video_aspect = ? AND v.duration >= ?
+                ORDER BY v.last_used DESC
+                """,
+                (_normalize_term(search_term), video_aspect, minimum_duration),
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to query the material index: {str(e)}")
+        return []
+
+    items = []
+    for url, path, provider, duration in rows:
+        if not os.path.isfile(path):
+            continue
+        items.append(
+            MaterialInfo(
+                type=MaterialType.VIDEO, provider=provider, url=url, duration=duration
+            )
+        )
+    return items
+
+
+def url_hash(video_url: str) -> str:
+    return utils.md5(video_url.split("?")[0])
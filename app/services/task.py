@@ -1,17 +1,20 @@
 import math
 import os.path
+import random
 import re
 from os import path
-import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
 
 from app.config import config
 from app.models import const
-from app.models.schema import VideoConcatMode, VideoParams
+from app.models.schema import RenderBackend, RenderMode, VideoConcatMode, VideoParams
 from app.models.material import MaterialInfo, MaterialType
-from app.services import llm, material, subtitle, video, voice
+from app.models.timeline import Timeline
+from app.services import llm, manifest, material, subtitle, video, voice
 from app.services import state as sm
+from app.services.video_processing.encoding import get_encoding_profile
 from app.utils import utils
 
 
@@ -72,7 +75,7 @@ def save_script_data(task_id, video_script, video_terms, params):
         f.write(utils.to_json(script_data))
 
 
-def generate_audio(task_id, params, video_script):
+def generate_audio(task_id, params, video_script, progress=None):
     logger.info("\n\n## generating audio")
     audio_file = path.join(utils.task_dir(task_id), "audio.mp3")
     sub_maker = voice.tts(
@@ -80,6 +83,7 @@ def generate_audio(task_id, params, video_script):
         voice_name=voice.parse_voice_name(params.voice_name),
         voice_rate=params.voice_rate,
         voice_file=audio_file,
+        progress=progress,
     )
     if sub_maker is None:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -139,7 +143,7 @@ def get_video_materials(
             try:
                 material_service = material.MaterialService()
                 output_dir = utils.task_dir(task_id)
-                materials = asyncio.run(material_service.generate_materials_from_script(
+                materials = utils.run_async(material_service.generate_materials_from_script(
                     script=params.video_script,
                     material_type=MaterialType.MIDJOURNEY,
                     output_dir=output_dir,
@@ -163,10 +167,10 @@ def get_video_materials(
             logger.error("no valid video clips generated from images")
             return None
             
-        return downloaded_videos
+        return material.normalize_videos(downloaded_videos, params.video_aspect)
     else:
         # Original video download logic for Pexels/Pixabay
-        downloaded_videos = video.download_videos(
+        downloaded_videos = material.download_videos(
             task_id=task_id,
             search_terms=video_terms,
             source=params.video_source,
@@ -174,16 +178,17 @@ def get_video_materials(
             video_contact_mode=params.video_concat_mode,
             audio_duration=audio_duration,
             max_clip_duration=params.video_clip_duration,
+            all_providers=params.search_all_providers,
         )
         if not downloaded_videos:
             logger.error("no videos downloaded")
             return None
             
-        return downloaded_videos
+        return material.normalize_videos(downloaded_videos, params.video_aspect)
 
 
 def generate_final_videos(
-    task_id, params, downloaded_videos, audio_file, subtitle_path
+    task_id, params, downloaded_videos, audio_file, subtitle_path, timelines=None
 ):
     final_video_paths = []
     combined_video_paths = []
@@ -194,6 +199,44 @@ def generate_final_videos(
         else VideoConcatMode.random
     )
     video_transition_mode = params.video_transition_mode
+    # a fixed seed lets a later render reproduce the same timelines
+    if params.video_seed is None:
+        params.video_seed = random.randint(0, 2**31 - 1)
+    is_preview = params.render_mode == RenderMode.preview.value
+
+    # the ffmpeg backend, previews and saved timelines always render in a single pass
+    if (
+        params.single_pass_render
+        or params.render_backend == RenderBackend.ffmpeg.value
+        or is_preview
+        or timelines
+    ):
+        prefix = "preview" if is_preview else "final"
+        for i in range(params.video_count):
+            index = i + 1
+            final_video_paths.append(
+                path.join(utils.task_dir(task_id), f"{prefix}-{index}.mp4")
+            )
+            if params.save_combined_video and not is_preview:
+                combined_video_paths.append(
+                    path.join(utils.task_dir(task_id), f"combined-{index}.mp4")
+                )
+
+        logger.info(f"\n\n## rendering {params.video_count} {prefix} videos")
+        video.render_videos(
+            video_paths=downloaded_videos,
+            audio_path=audio_file,
+            subtitle_path=subtitle_path,
+            output_files=final_video_paths,
+            params=params,
+            video_concat_mode=video_concat_mode,
+            combined_video_paths=combined_video_paths,
+            timelines=timelines,
+            progress=lambda done, total: sm.state.update_task(
+                task_id, progress=50 + 50 * done / total
+            ),
+        )
+        return final_video_paths, combined_video_paths
 
     _progress = 50
     for i in range(params.video_count):
@@ -201,6 +244,8 @@ def generate_final_videos(
         combined_video_path = path.join(
             utils.task_dir(task_id), f"combined-{index}.mp4"
         )
+        final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
+
         logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
         video.combine_videos(
             combined_video_path=combined_video_path,
@@ -211,13 +256,12 @@ def generate_final_videos(
             video_transition_mode=video_transition_mode,
             max_clip_duration=params.video_clip_duration,
             threads=params.n_threads,
+            encoding=get_encoding_profile(params),
         )
 
         _progress += 50 / params.video_count / 2
         sm.state.update_task(task_id, progress=_progress)
 
-        final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
-
         logger.info(f"\n\n## generating video: {index} => {final_video_path}")
         video.generate_video(
             video_path=combined_video_path,
@@ -236,18 +280,51 @@ def generate_final_videos(
     return final_video_paths, combined_video_paths
 
 
-def start(task_id, params: VideoParams, stop_at: str = "video"):
-    logger.info(f"start task: {task_id}, stop_at: {stop_at}")
+def _get_sub_maker(data: dict):
+    sub_maker = voice.SubMaker()
+    sub_maker.subs = list(data.get("subs", []))
+    sub_maker.offset = [tuple(offset) for offset in data.get("offset", [])]
+    return sub_maker
+
+
+def start(task_id, params: VideoParams, stop_at: str = "video", resume: bool = False):
+    """
+    Every stage saves its outputs in the manifest of the task dir, keyed by a
+    hash of its inputs. With resume, the stages whose inputs are unchanged are
+    skipped, so a retry after a failed render does not call the LLM, the TTS
+    or the stock footage APIs again.
+    """
+    logger.info(f"start task: {task_id}, stop_at: {stop_at}, resume: {resume}")
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
 
     if type(params.video_concat_mode) is str:
         params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
 
+    manifest.save_task(task_id, params, stop_at)
+
+    def _cached(stage, key):
+        if not resume:
+            return None
+        return manifest.get_stage(task_id, stage, key)
+
     # 1. Generate script
-    video_script = generate_script(task_id, params)
-    if not video_script or "Error: " in video_script:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
+    script_key = manifest.stage_key(
+        "script",
+        params.video_subject,
+        params.video_script,
+        params.video_language,
+        params.paragraph_number,
+        config.app.get("llm_provider", "openai"),
+    )
+    cached = _cached("script", script_key)
+    if cached:
+        video_script = cached["script"]
+    else:
+        video_script = generate_script(task_id, params)
+        if not video_script or "Error: " in video_script:
+            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+            return
+        manifest.save_stage(task_id, "script", script_key, {"script": video_script})
 
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=10)
 
@@ -260,10 +337,18 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     # 2. Generate terms
     video_terms = ""
     if params.video_source != "local":
-        video_terms = generate_terms(task_id, params, video_script)
-        if not video_terms:
-            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-            return
+        terms_key = manifest.stage_key(
+            "terms", script_key, video_script, params.video_subject, params.video_terms
+        )
+        cached = _cached("terms", terms_key)
+        if cached:
+            video_terms = cached["terms"]
+        else:
+            video_terms = generate_terms(task_id, params, video_script)
+            if not video_terms:
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+                return
+            manifest.save_stage(task_id, "terms", terms_key, {"terms": video_terms})
 
     save_script_data(task_id, video_script, video_terms, params)
 
@@ -275,48 +360,149 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
 
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
 
-    # 3. Generate audio
-    audio_file, audio_duration, sub_maker = generate_audio(
-        task_id, params, video_script
+    # 3-5. Audio, subtitles and materials. The materials only need the audio
+    # duration to know when to stop downloading, so they are fetched while the
+    # audio and subtitles are generated, against an estimated duration until
+    # the real one is known.
+    audio_key = manifest.stage_key(
+        "audio", video_script, params.voice_name, params.voice_rate
     )
-    if not audio_file:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
-
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=30)
-
-    if stop_at == "audio":
-        sm.state.update_task(
-            task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            audio_file=audio_file,
-        )
-        return {"audio_file": audio_file, "audio_duration": audio_duration}
-
-    # 4. Generate subtitle
-    subtitle_path = generate_subtitle(
-        task_id, params, video_script, sub_maker, audio_file
+    subtitle_key = manifest.stage_key(
+        "subtitle",
+        audio_key,
+        params.subtitle_enabled,
+        config.app.get("subtitle_provider", ""),
+    )
+    materials_key = manifest.stage_key(
+        "materials",
+        audio_key,
+        video_terms,
+        params.video_source,
+        params.video_aspect,
+        params.video_concat_mode,
+        params.video_clip_duration,
+        params.video_materials,
+        params.search_all_providers,
+        # generated images depend on the script
+        video_script if params.video_source in ("midjourney", "local") else "",
     )
 
-    if stop_at == "subtitle":
-        sm.state.update_task(
+    audio_file, audio_duration, sub_maker = None, 0, None
+    cached = _cached("audio", audio_key)
+    if cached:
+        audio_file = cached["audio_file"]
+        audio_duration = cached["audio_duration"]
+        sub_maker = _get_sub_maker(cached["sub_maker"])
+
+    downloaded_videos = None
+    duration_target = None
+    materials_future = None
+    executor = ThreadPoolExecutor(max_workers=1)
+    if stop_at not in ("audio", "subtitle"):
+        cached = _cached("materials", materials_key)
+        if cached:
+            downloaded_videos = cached["materials"]
+        else:
+            duration_target = material.DurationTarget(
+                voice.estimate_duration(video_script, params.voice_rate)
+            )
+            if audio_file:
+                duration_target.set(audio_duration)
+            materials_future = executor.submit(
+                get_video_materials, task_id, params, video_terms, duration_target
+            )
+
+    audio_progress = [20]
+
+    def _on_audio_progress(tts_progress: dict):
+        # the materials follow the duration projected from the speech so far
+        if duration_target:
+            duration_target.update(tts_progress["estimated_duration"])
+        if tts_progress["total_chars"]:
+            done = min(tts_progress["chars"] / tts_progress["total_chars"], 1)
+            progress = int(20 + 10 * done)
+            if progress > audio_progress[0]:
+                audio_progress[0] = progress
+                sm.state.update_task(
+                    task_id, state=const.TASK_STATE_PROCESSING, progress=progress
+                )
+
+    try:
+        if not audio_file:
+            audio_file, audio_duration, sub_maker = generate_audio(
+                task_id, params, video_script, progress=_on_audio_progress
+            )
+            if not audio_file:
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+                return
+            manifest.save_stage(
+                task_id,
+                "audio",
+                audio_key,
+                {
+                    "audio_file": audio_file,
+                    "audio_duration": audio_duration,
+                    "sub_maker": {"subs": sub_maker.subs, "offset": sub_maker.offset},
+                },
+                files=[audio_file],
+            )
+        if duration_target:
+            duration_target.set(audio_duration)
+
+        sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=30)
+
+        if stop_at == "audio":
+            sm.state.update_task(
+                task_id,
+                state=const.TASK_STATE_COMPLETE,
+                progress=100,
+                audio_file=audio_file,
+            )
+            return {"audio_file": audio_file, "audio_duration": audio_duration}
+
+        cached = _cached("subtitle", subtitle_key)
+        if cached:
+            subtitle_path = cached["subtitle_path"]
+        else:
+            subtitle_path = generate_subtitle(
+                task_id, params, video_script, sub_maker, audio_file
+            )
+            manifest.save_stage(
+                task_id,
+                "subtitle",
+                subtitle_key,
+                {"subtitle_path": subtitle_path},
+                files=[subtitle_path],
+            )
+
+        if stop_at == "subtitle":
+            sm.state.update_task(
+                task_id,
+                state=const.TASK_STATE_COMPLETE,
+                progress=100,
+                subtitle_path=subtitle_path,
+            )
+            return {"subtitle_path": subtitle_path}
+
+        sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
+    finally:
+        # a failed audio stage stops the downloads after the current video
+        if duration_target and not duration_target.is_final():
+            duration_target.set(0)
+        executor.shutdown(wait=True)
+
+    if materials_future:
+        downloaded_videos = materials_future.result()
+        if not downloaded_videos:
+            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+            return
+        manifest.save_stage(
             task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            subtitle_path=subtitle_path,
+            "materials",
+            materials_key,
+            {"materials": downloaded_videos},
+            files=downloaded_videos,
         )
-        return {"subtitle_path": subtitle_path}
-
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
-
-    # 5. Get video materials
-    downloaded_videos = get_video_materials(
-        task_id, params, video_terms, audio_duration
-    )
-    if not downloaded_videos:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
 
     if stop_at == "materials":
         sm.state.update_task(
@@ -330,13 +516,36 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
 
     # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
+    render_key = manifest.stage_key(
+        "render",
+        materials_key,
+        subtitle_key,
+        params.model_dump(mode="json", warnings=False),
     )
+    cached = _cached("render", render_key)
+    if cached:
+        final_video_paths = cached["videos"]
+        combined_video_paths = cached["combined_videos"]
+        params.video_seed = cached["video_seed"]
+    else:
+        final_video_paths, combined_video_paths = generate_final_videos(
+            task_id, params, downloaded_videos, audio_file, subtitle_path
+        )
 
-    if not final_video_paths:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
+        if not final_video_paths:
+            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+            return
+        manifest.save_stage(
+            task_id,
+            "render",
+            render_key,
+            {
+                "videos": final_video_paths,
+                "combined_videos": combined_video_paths,
+                "video_seed": params.video_seed,
+            },
+            files=final_video_paths + combined_video_paths,
+        )
 
     logger.success(
         f"task {task_id} finished, generated {len(final_video_paths)} videos."
@@ -345,6 +554,8 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     kwargs = {
         "videos": final_video_paths,
         "combined_videos": combined_video_paths,
+        "render_mode": params.render_mode,
+        "video_seed": params.video_seed,
         "script": video_script,
         "terms": video_terms,
         "audio_file": audio_file,
@@ -358,6 +569,84 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     return kwargs
 
 
+def resume_task(task_id):
+    """Restart a task with the params it was started with, skipping finished stages"""
+    data = manifest.load(task_id)
+    if not data.get("params"):
+        logger.error(f"task {task_id} has no manifest to resume from")
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        return
+    params = VideoParams(**data["params"])
+    return start(task_id, params, stop_at=data.get("stop_at", "video"), resume=True)
+
+
+def _load_preview_timelines(preview_videos, count):
+    """The timelines saved next to the preview videos, None if any is missing"""
+    timelines = []
+    for preview_video in preview_videos[:count]:
+        timeline_path = video.get_timeline_path(preview_video)
+        try:
+            timelines.append(Timeline.load(timeline_path))
+        except Exception as e:
+            logger.warning(f"invalid preview timeline: {timeline_path}, {str(e)}")
+            return None
+    if len(timelines) != count:
+        logger.warning("the preview has fewer videos than requested, planning again")
+        return None
+    return timelines
+
+
+def render_final(task_id, params: VideoParams):
+    """
+    Final render of a task that was rendered in preview mode. The script,
+    audio, subtitles and materials of the preview are reused, and so are its
+    timelines (fitted to the final format), so the cuts match what was reviewed.
+    """
+    task = sm.state.get_task(task_id)
+    if not task or not task.get("audio_file") or not task.get("materials"):
+        logger.error(f"task {task_id} has no rendered artifacts to reuse")
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        return
+
+    task = dict(task)
+    logger.info(f"start final render of task: {task_id}")
+    params.render_mode = RenderMode.final.value
+    if params.video_seed is None:
+        params.video_seed = task.get("video_seed")
+    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
+
+    timelines = _load_preview_timelines(task.get("videos", []), params.video_count)
+    final_video_paths, combined_video_paths = generate_final_videos(
+        task_id,
+        params,
+        task["materials"],
+        task["audio_file"],
+        task.get("subtitle_path", ""),
+        timelines=timelines,
+    )
+    if not final_video_paths:
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        return
+
+    logger.success(
+        f"task {task_id} finished, generated {len(final_video_paths)} videos."
+    )
+    task.pop("state", None)
+    task.pop("progress", None)
+    kwargs = {
+        **task,
+        "videos": final_video_paths,
+        "combined_videos": combined_video_paths,
+        "preview_videos": task.get("videos", []),
+        "render_mode": params.render_mode,
+        "video_seed": params.video_seed,
+    }
+    sm.state.update_task(
+        task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
+    )
+    return kwargs
+
+
 if __name__ == "__main__":
     task_id = "task_id"
     params = VideoParams(
@@ -2,34 +2,49 @@ import glob
 import os
 import random
 import math
-from typing import List
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import replace
+from functools import lru_cache
+from typing import Callable, List
 
 from loguru import logger
 from moviepy import (
-    AudioFileClip,
     ColorClip,
-    CompositeAudioClip,
     CompositeVideoClip,
     ImageClip,
-    TextClip,
     VideoFileClip,
-    afx,
     concatenate_videoclips,
+    vfx,
 )
-from moviepy.video.tools.subtitles import SubtitlesClip
-from PIL import ImageFont
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import Image, ImageDraw, ImageFont
+from PIL.PngImagePlugin import PngInfo
 
+from app.config import config
 from app.models import const
 from app.models.schema import (
     MaterialInfo,
+    RenderBackend,
+    RenderMode,
     VideoAspect,
     VideoConcatMode,
     VideoParams,
     VideoTransitionMode,
 )
+from app.models.timeline import Timeline, TimelineClip
 from app.services.utils import video_effects
+from app.services.video_processing import ffmpeg_render, ffmpeg_utils, segment_cache
+from app.services.video_processing.encoding import (
+    get_encoding_profile,
+    moviepy_write_args,
+)
 from app.utils import utils
 
+# seconds a slice end may move to land on a keyframe, see _snap_to_keyframe
+KEYFRAME_SNAP = 1.0
+
 
 def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     if not bgm_type:
@@ -47,192 +62,665 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     return ""
 
 
-def combine_videos(
-    combined_video_path: str,
+def _fit_size(clip_w: int, clip_h: int, video_width: int, video_height: int):
+    """
+    Size the clip is scaled to so it fits inside the target frame while keeping
+    its aspect ratio, the rest of the frame is letterboxed with black.
+    """
+    if clip_w == video_width and clip_h == video_height:
+        return clip_w, clip_h
+
+    clip_ratio = clip_w / clip_h
+    video_ratio = video_width / video_height
+    if clip_ratio == video_ratio:
+        return video_width, video_height
+
+    if clip_ratio > video_ratio:
+        scale_factor = video_width / clip_w
+    else:
+        scale_factor = video_height / clip_h
+    return int(clip_w * scale_factor), int(clip_h * scale_factor)
+
+
+def _copyable_keyframes(
+    infos: dict, video_width: int, video_height: int, fps: int, transition_mode
+) -> dict:
+    """
+    Keyframe times per source when every source can be stream copied as-is:
+    h264 in the target size and fps, one set of codec headers (the concat
+    demuxer keeps only the first segment's) and no transitions. Empty otherwise.
+    """
+    if transition_mode:
+        return {}
+    for info in infos.values():
+        if (
+            info["codec"] != "h264"
+            or (info["width"], info["height"]) != (video_width, video_height)
+            or abs(info["fps"] - fps) >= 0.01
+        ):
+            return {}
+
+    keyframes = {}
+    headers = set()
+    for video_path in infos:
+        try:
+            info = ffmpeg_utils.get_keyframe_info(video_path)
+        except Exception as e:
+            logger.warning(f"failed to probe keyframes: {video_path} => {str(e)}")
+            return {}
+        keyframes[video_path] = info["keyframes"]
+        headers.add(info["stream_headers"])
+    return keyframes if len(headers) == 1 else {}
+
+
+def _snap_to_keyframe(
+    keyframes: List[float], start: float, end: float, source_duration: float
+) -> float:
+    """
+    Move the end of a slice back onto a keyframe, so the slice can be stream
+    copied frame exact. The end moves by at most KEYFRAME_SNAP seconds and
+    the slice never gets longer than planned. Without a keyframe in reach the
+    end stays where it is.
+    """
+    if end >= source_duration:
+        return end
+    candidates = [
+        k for k in keyframes if start < k and end - KEYFRAME_SNAP <= k <= end + 0.001
+    ]
+    return max(candidates, default=end)
+
+
+def _plan_timeline(
     video_paths: List[str],
-    audio_file: str,
-    video_aspect: VideoAspect = VideoAspect.portrait,
+    audio_duration: float,
+    video_width: int,
+    video_height: int,
+    fps: int = 30,
     video_concat_mode: VideoConcatMode = VideoConcatMode.random,
     video_transition_mode: VideoTransitionMode = None,
     max_clip_duration: int = 5,
-    threads: int = 2,
-) -> str:
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
-    logger.info(f"max duration of audio: {audio_duration} seconds")
-    
+    probes: dict = None,
+    seed: int = None,
+    stream_copy: bool = False,
+) -> Timeline:
+    """
+    Decide which slice of which source goes where on the timeline, how it is
+    scaled and which transition it gets. Every random choice comes from the
+    timeline seed, both render backends only execute the timeline.
+    Pass the result of _probe_videos as probes to skip probing the sources again.
+    Pass stream_copy when nothing is drawn over the clips (no subtitles), then
+    the slices of sources that can be copied as-is are cut on keyframes.
+    """
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    rng = random.Random(seed)
+
     # Calculate required duration for each clip based on audio length and number of clips
     num_clips = len(video_paths)
     req_dur = audio_duration / num_clips
     # Use the smaller of calculated duration or max_clip_duration
     req_dur = min(req_dur, max_clip_duration)
     logger.info(f"each clip will be {req_dur:.2f} seconds long (audio duration: {audio_duration:.2f}s, clips: {num_clips})")
-    
-    output_dir = os.path.dirname(combined_video_path)
-    aspect = VideoAspect(video_aspect)
-    video_width, video_height = aspect.to_resolution()
 
-    clips = []
-    video_duration = 0
+    transition_mode = video_transition_mode.value if video_transition_mode else None
+
+    infos = {}
+    for video_path in dict.fromkeys(video_paths):
+        if probes and video_path in probes:
+            infos[video_path] = probes[video_path]
+        else:
+            infos[video_path] = ffmpeg_utils.get_video_info(video_path)
+    keyframes = {}
+    if stream_copy:
+        keyframes = _copyable_keyframes(
+            infos, video_width, video_height, fps, transition_mode
+        )
+
     raw_clips = []
-    
     for video_path in video_paths:
-        clip = VideoFileClip(video_path).without_audio()
-        clip_duration = clip.duration
+        info = infos[video_path]
+        clip_duration = info["duration"]
+        source_keyframes = keyframes.get(video_path)
+        scaled_width, scaled_height = _fit_size(
+            info["width"], info["height"], video_width, video_height
+        )
+        source = {
+            "path": video_path,
+            "width": info["width"],
+            "height": info["height"],
+            "fps": info["fps"],
+            "codec": info["codec"],
+            "pix_fmt": info["pix_fmt"],
+            "scaled_width": scaled_width,
+            "scaled_height": scaled_height,
+            "x": (video_width - scaled_width) // 2,
+            "y": (video_height - scaled_height) // 2,
+        }
         start_time = 0
 
         # For sequential mode, just take one clip per video
         if video_concat_mode.value == VideoConcatMode.sequential.value:
-            split_clip = clip.subclipped(0, min(req_dur, clip_duration))
-            raw_clips.append(split_clip)
+            end_time = min(req_dur, clip_duration)
+            if source_keyframes:
+                end_time = _snap_to_keyframe(
+                    source_keyframes, 0, end_time, clip_duration
+                )
+            raw_clips.append({**source, "start": 0, "end": end_time})
         else:
             # For random mode, split into multiple clips if needed
             while start_time < clip_duration:
                 end_time = min(start_time + req_dur, clip_duration)
-                split_clip = clip.subclipped(start_time, end_time)
-                raw_clips.append(split_clip)
+                if source_keyframes:
+                    end_time = _snap_to_keyframe(
+                        source_keyframes, start_time, end_time, clip_duration
+                    )
+                raw_clips.append({**source, "start": start_time, "end": end_time})
                 start_time = end_time
 
     # random video_paths order for non-sequential mode
     if video_concat_mode.value == VideoConcatMode.random.value:
-        random.shuffle(raw_clips)
+        rng.shuffle(raw_clips)
 
+    clips = []
     remaining_duration = audio_duration
     for clip in raw_clips:
         if remaining_duration <= 0:
             break
-            
+
+        source_duration = infos[clip["path"]]["duration"]
+        clip_duration = clip["end"] - clip["start"]
+        loops = 1
         # Adjust clip duration to fit remaining time
-        if clip.duration > remaining_duration:
-            clip = clip.subclipped(0, remaining_duration)
-        elif clip.duration < req_dur:
+        if clip_duration > remaining_duration:
+            clip["end"] = clip["start"] + remaining_duration
+            clip_duration = remaining_duration
+        elif clip_duration < req_dur and clip["end"] >= source_duration:
             # For short clips, loop them to reach required duration
-            repeats = math.ceil(req_dur / clip.duration)
-            clip = clip.loop(n=repeats).subclipped(0, min(req_dur, remaining_duration))
-            
-        clip = clip.with_fps(30)
+            loops = math.ceil(req_dur / clip_duration)
+            clip_duration = min(req_dur, remaining_duration)
 
-        # Resize clip if needed
-        clip_w, clip_h = clip.size
-        if clip_w != video_width or clip_h != video_height:
-            clip_ratio = clip.w / clip.h
-            video_ratio = video_width / video_height
+        shuffle_side = rng.choice(["left", "right", "top", "bottom"])
+        transition = transition_mode
+        if transition == VideoTransitionMode.shuffle.value:
+            transition = rng.choice(
+                [
+                    VideoTransitionMode.fade_in.value,
+                    VideoTransitionMode.fade_out.value,
+                    VideoTransitionMode.slide_in.value,
+                    VideoTransitionMode.slide_out.value,
+                ]
+            )
 
-            if clip_ratio == video_ratio:
+        clips.append(
+            TimelineClip(
+                **clip,
+                loops=loops,
+                duration=clip_duration,
+                transition=transition,
+                side=shuffle_side,
+            )
+        )
+        remaining_duration -= clip_duration
+
+    return Timeline(
+        width=video_width, height=video_height, fps=fps, seed=seed, clips=clips
+    )
+
+
+def _fit_timeline(
+    timeline: Timeline, video_width: int, video_height: int, fps: int
+) -> Timeline:
+    """The same cuts in another output format, only the geometry is computed again"""
+    size = (video_width, video_height)
+    if (timeline.width, timeline.height) == size and timeline.fps == fps:
+        return timeline
+    clips = []
+    for clip in timeline.clips:
+        scaled_width, scaled_height = _fit_size(
+            clip.width, clip.height, video_width, video_height
+        )
+        clips.append(
+            replace(
+                clip,
+                scaled_width=scaled_width,
+                scaled_height=scaled_height,
+                x=(video_width - scaled_width) // 2,
+                y=(video_height - scaled_height) // 2,
+            )
+        )
+    return replace(
+        timeline, width=video_width, height=video_height, fps=fps, clips=clips
+    )
+
+
+def _probe_videos(video_paths: List[str]) -> dict:
+    return {
+        video_path: ffmpeg_utils.get_video_info(video_path)
+        for video_path in dict.fromkeys(video_paths)
+    }
+
+
+def _can_stream_copy(timeline: Timeline, pix_fmt: str = "yuv420p") -> bool:
+    return any(ffmpeg_render.copyable_clips(timeline, pix_fmt))
+
+
+def _build_video_clip(timeline: Timeline, sources: dict = None):
+    # pass a dict as sources to share the decoders between several timelines
+    if sources is None:
+        sources = {}
+    video_width, video_height, fps = timeline.width, timeline.height, timeline.fps
+    clips = []
+    for item in timeline.clips:
+        video_path = item.path
+        if video_path not in sources:
+            sources[video_path] = VideoFileClip(video_path).without_audio()
+
+        clip = sources[video_path].subclipped(item.start, item.end)
+        if item.loops > 1:
+            clip = clip.with_effects([vfx.Loop(n=item.loops)])
+        clip = clip.subclipped(0, item.duration)
+        clip = clip.with_fps(fps)
+
+        # Resize clip if needed
+        new_width, new_height = item.scaled_width, item.scaled_height
+        if (new_width, new_height) == (video_width, video_height):
+            if tuple(clip.size) != (video_width, video_height):
                 clip = clip.resized((video_width, video_height))
-            else:
-                if clip_ratio > video_ratio:
-                    scale_factor = video_width / clip_w
-                else:
-                    scale_factor = video_height / clip_h
-
-                new_width = int(clip_w * scale_factor)
-                new_height = int(clip_h * scale_factor)
-                clip_resized = clip.resized(new_size=(new_width, new_height))
-
-                background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
-                clip = CompositeVideoClip([
-                    background.with_duration(clip.duration),
-                    clip_resized.with_position("center"),
-                ])
+        else:
+            clip_resized = clip.resized(new_size=(new_width, new_height))
+            background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
+            clip = CompositeVideoClip([
+                background.with_duration(clip.duration),
+                clip_resized.with_position((item.x, item.y)),
+            ])
 
         # Apply transitions
-        shuffle_side = random.choice(["left", "right", "top", "bottom"])
-        if video_transition_mode.value == VideoTransitionMode.fade_in.value:
+        transition = item.transition
+        if transition == VideoTransitionMode.fade_in.value:
             clip = video_effects.fadein_transition(clip, 1)
-        elif video_transition_mode.value == VideoTransitionMode.fade_out.value:
+        elif transition == VideoTransitionMode.fade_out.value:
             clip = video_effects.fadeout_transition(clip, 1)
-        elif video_transition_mode.value == VideoTransitionMode.slide_in.value:
-            clip = video_effects.slidein_transition(clip, 1, shuffle_side)
-        elif video_transition_mode.value == VideoTransitionMode.slide_out.value:
-            clip = video_effects.slideout_transition(clip, 1, shuffle_side)
-        elif video_transition_mode.value == VideoTransitionMode.shuffle.value:
-            transition_funcs = [
-                lambda c: video_effects.fadein_transition(c, 1),
-                lambda c: video_effects.fadeout_transition(c, 1),
-                lambda c: video_effects.slidein_transition(c, 1, shuffle_side),
-                lambda c: video_effects.slideout_transition(c, 1, shuffle_side),
-            ]
-            clip = random.choice(transition_funcs)(clip)
+        elif transition == VideoTransitionMode.slide_in.value:
+            clip = video_effects.slidein_transition(clip, 1, item.side)
+        elif transition == VideoTransitionMode.slide_out.value:
+            clip = video_effects.slideout_transition(clip, 1, item.side)
 
         clips.append(clip)
-        remaining_duration -= clip.duration
-        video_duration += clip.duration
 
     clips = [CompositeVideoClip([clip]) for clip in clips]
     video_clip = concatenate_videoclips(clips)
-    video_clip = video_clip.with_fps(30)
-    
+    video_clip = video_clip.with_fps(fps)
+    return video_clip
+
+
+def combine_videos(
+    combined_video_path: str,
+    video_paths: List[str],
+    audio_file: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    threads: int = 2,
+    encoding: dict = None,
+) -> str:
+    encoding = encoding or get_encoding_profile()
+    audio_duration = ffmpeg_utils.probe_video(audio_file)["duration"]
+    logger.info(f"max duration of audio: {audio_duration} seconds")
+
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    timeline = _plan_timeline(
+        video_paths=video_paths,
+        audio_duration=audio_duration,
+        video_width=video_width,
+        video_height=video_height,
+        video_concat_mode=video_concat_mode,
+        video_transition_mode=video_transition_mode,
+        max_clip_duration=max_clip_duration,
+        stream_copy=True,
+    )
+    timeline.save(get_timeline_path(combined_video_path))
+
+    if _can_stream_copy(timeline, encoding["pix_fmt"]):
+        logger.info("writing video file, stream copy fast path")
+        ffmpeg_render.render_segments(
+            timeline=timeline,
+            output_file=combined_video_path,
+            threads=threads,
+            encoding=encoding,
+            stream_copy=True,
+        )
+        logger.success("completed")
+        return combined_video_path
+
+    video_clip = _build_video_clip(timeline)
+
+    # the audio is mixed and muxed in generate_video, none is written here
     logger.info("writing video file")
     video_clip.write_videofile(
         filename=combined_video_path,
         threads=threads,
         logger=None,
-        temp_audiofile_path=output_dir,
-        audio_codec="aac",
-        fps=30,
+        audio=False,
+        fps=timeline.fps,
+        **moviepy_write_args(encoding),
     )
     video_clip.close()
     logger.success("completed")
     return combined_video_path
 
 
-def wrap_text(text, max_width, font="Arial", fontsize=60):
-    # Create ImageFont
-    font = ImageFont.truetype(font, fontsize)
+@lru_cache(maxsize=32)
+def _load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    # opening a ttc parses the whole collection, keep the loaded fonts around
+    return ImageFont.truetype(font_path, font_size)
+
 
-    def get_text_size(inner_text):
-        inner_text = inner_text.strip()
-        left, top, right, bottom = font.getbbox(inner_text)
-        return right - left, bottom - top
+@lru_cache(maxsize=65536)
+def _get_advance(font_path: str, font_size: int, text: str) -> float:
+    return _load_font(font_path, font_size).getlength(text)
 
-    width, height = get_text_size(text)
+
+def wrap_text(text, max_width, font="Arial", fontsize=60):
+    """
+    Greedy line wrapping by words, or by characters when a single word does
+    not fit (CJK text has no spaces). Line widths are summed from cached
+    per-word / per-glyph advances, so the cost is linear in the text length.
+    """
+    font_path = font
+    ascent, descent = _load_font(font_path, fontsize).getmetrics()
+    height = ascent + descent
+
+    width = sum(_get_advance(font_path, fontsize, char) for char in text.strip())
     if width <= max_width:
         return text, height
 
-    # logger.warning(f"wrapping text, max_width: {max_width}, text_width: {width}, text: {text}")
-
-    processed = True
+    space_width = _get_advance(font_path, fontsize, " ")
 
-    _wrapped_lines_ = []
-    words = text.split(" ")
-    _txt_ = ""
-    for word in words:
-        _before = _txt_
-        _txt_ += f"{word} "
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            if _txt_.strip() == word.strip():
-                processed = False
-                break
-            _wrapped_lines_.append(_before)
-            _txt_ = f"{word} "
-    _wrapped_lines_.append(_txt_)
-    if processed:
-        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
-        result = "\n".join(_wrapped_lines_).strip()
-        height = len(_wrapped_lines_) * height
-        # logger.warning(f"wrapped text: {result}")
-        return result, height
-
-    _wrapped_lines_ = []
-    chars = list(text)
-    _txt_ = ""
-    for word in chars:
-        _txt_ += word
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
+    wrapped_lines = []
+    line, line_width = [], 0
+    for word in text.split(" "):
+        if not word:
             continue
+        word_width = sum(_get_advance(font_path, fontsize, char) for char in word)
+        if word_width > max_width:
+            wrapped_lines = None
+            break
+        if line and line_width + space_width + word_width > max_width:
+            wrapped_lines.append(" ".join(line))
+            line, line_width = [word], word_width
+        elif line:
+            line.append(word)
+            line_width += space_width + word_width
         else:
-            _wrapped_lines_.append(_txt_)
-            _txt_ = ""
-    _wrapped_lines_.append(_txt_)
-    result = "\n".join(_wrapped_lines_).strip()
-    height = len(_wrapped_lines_) * height
-    # logger.warning(f"wrapped text: {result}")
-    return result, height
+            line, line_width = [word], word_width
+
+    if wrapped_lines is not None:
+        wrapped_lines.append(" ".join(line))
+        return "\n".join(wrapped_lines).strip(), len(wrapped_lines) * height
+
+    wrapped_lines = []
+    line, line_width = [], 0
+    for char in text:
+        char_width = _get_advance(font_path, fontsize, char)
+        if line and line_width + char_width > max_width:
+            wrapped_lines.append("".join(line).strip())
+            line, line_width = [], 0
+        line.append(char)
+        line_width += char_width
+    wrapped_lines.append("".join(line).strip())
+    return "\n".join(wrapped_lines).strip(), len(wrapped_lines) * height
+
+
+def _get_font_path(params: VideoParams) -> str:
+    font_path = ""
+    if params.subtitle_enabled:
+        if not params.font_name:
+            params.font_name = "STHeitiMedium.ttc"
+        font_path = os.path.join(utils.font_dir(), params.font_name)
+        if os.name == "nt":
+            font_path = font_path.replace("\\", "/")
+
+        logger.info(f"using font: {font_path}")
+    return font_path
+
+
+def _get_subtitle_y(params: VideoParams, video_height: int, text_height: int):
+    if params.subtitle_position == "bottom":
+        return video_height * 0.95 - text_height
+    elif params.subtitle_position == "top":
+        return video_height * 0.05
+    elif params.subtitle_position == "custom":
+        # Ensure the subtitle is fully within the screen bounds
+        margin = 10  # Additional margin, in pixels
+        max_y = video_height - text_height - margin
+        min_y = margin
+        custom_y = (video_height - text_height) * (params.custom_position / 100)
+        # Constrain the y value within the valid range
+        return max(min_y, min(custom_y, max_y))
+    # center
+    return (video_height - text_height) / 2
+
+
+def _create_subtitle_clips(
+    subtitle_path: str, params: VideoParams, video_width: int, video_height: int
+) -> list:
+    """moviepy overlays of the cached subtitle sprites, the same images the ffmpeg backend uses"""
+    text_clips = []
+    for sprite in _create_subtitle_images(
+        subtitle_path, params, video_width, video_height
+    ):
+        _clip = ImageClip(sprite["path"])
+        _clip = _clip.with_start(sprite["start"])
+        _clip = _clip.with_end(sprite["end"])
+        _clip = _clip.with_duration(sprite["end"] - sprite["start"])
+        _clip = _clip.with_position((sprite["x"], sprite["y"]))
+        text_clips.append(_clip)
+    return text_clips
+
+
+def _render_text_image(
+    text: str,
+    font_path: str,
+    font_size: int,
+    color: str,
+    bg_color,
+    stroke_color: str,
+    stroke_width: int,
+) -> Image.Image:
+    # Same layout as moviepy's TextClip (method="label"), so both render
+    # backends place and draw the subtitles identically.
+    interline = 4
+    font = _load_font(font_path, font_size)
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    left, top, right, bottom = draw.multiline_textbbox(
+        (0, 0),
+        text,
+        font=font,
+        spacing=interline,
+        stroke_width=stroke_width,
+        anchor="lm",
+    )
+    width, height = int(right - left), int(bottom - top)
+
+    if not isinstance(bg_color, str) or bg_color == "transparent":
+        bg_color = (0, 0, 0, 0)
+    img = Image.new("RGBA", (width, height), color=bg_color)
+    ImageDraw.Draw(img).multiline_text(
+        xy=(0, height / 2),
+        text=text,
+        fill=color,
+        font=font,
+        spacing=interline,
+        stroke_width=stroke_width,
+        stroke_fill=stroke_color,
+        anchor="lm",
+    )
+    return img
+
+
+def _get_subtitle_sprite(
+    text: str,
+    font_path: str,
+    font_size: int,
+    color: str,
+    bg_color,
+    stroke_color: str,
+    stroke_width: int,
+    max_width: float,
+) -> dict:
+    """
+    Wrapped and rasterized subtitle line, cached as an RGBA png under
+    storage/cache_subtitles. The key covers everything that changes the
+    pixels, the wrapped text is kept in the png metadata.
+    """
+    cache_dir = utils.storage_dir("cache_subtitles", create=True)
+    cache_key = utils.md5(
+        "|".join(
+            str(v)
+            for v in (
+                text,
+                font_path,
+                font_size,
+                color,
+                bg_color,
+                stroke_color,
+                stroke_width,
+                int(max_width),
+            )
+        )
+    )
+    sprite_path = os.path.join(cache_dir, f"{cache_key}.png")
+
+    if os.path.exists(sprite_path):
+        try:
+            with Image.open(sprite_path) as img:
+                utils.touch_file(sprite_path)
+                return {
+                    "path": sprite_path,
+                    "text": img.text.get("wrapped", text),
+                    "width": img.width,
+                    "height": img.height,
+                }
+        except Exception as e:
+            logger.warning(f"invalid subtitle sprite: {sprite_path} => {str(e)}")
+
+    wrapped_txt, _ = wrap_text(
+        text, max_width=max_width, font=font_path, fontsize=font_size
+    )
+    img = _render_text_image(
+        text=wrapped_txt,
+        font_path=font_path,
+        font_size=font_size,
+        color=color,
+        bg_color=bg_color,
+        stroke_color=stroke_color,
+        stroke_width=stroke_width,
+    )
+    metadata = PngInfo()
+    metadata.add_text("wrapped", wrapped_txt)
+    # segment workers may render the same line at the same time
+    temp_path = f"{sprite_path}.{utils.get_uuid(remove_hyphen=True)}.tmp"
+    img.save(temp_path, format="PNG", pnginfo=metadata)
+    os.replace(temp_path, sprite_path)
+    return {
+        "path": sprite_path,
+        "text": wrapped_txt,
+        "width": img.width,
+        "height": img.height,
+    }
+
+
+def _create_subtitle_images(
+    subtitle_path: str,
+    params: VideoParams,
+    video_width: int,
+    video_height: int,
+) -> List[dict]:
+    if not subtitle_path or not os.path.exists(subtitle_path):
+        return []
+
+    font_path = _get_font_path(params)
+    params.font_size = int(params.font_size)
+    params.stroke_width = int(params.stroke_width)
+
+    images = []
+    for (start, end), phrase in file_to_subtitles(subtitle_path, encoding="utf-8"):
+        sprite = _get_subtitle_sprite(
+            text=phrase,
+            font_path=font_path,
+            font_size=params.font_size,
+            color=params.text_fore_color,
+            bg_color=params.text_background_color,
+            stroke_color=params.stroke_color,
+            stroke_width=params.stroke_width,
+            max_width=video_width * 0.9,
+        )
+        images.append(
+            {
+                "path": sprite["path"],
+                "start": start,
+                "end": end,
+                "x": (video_width - sprite["width"]) / 2,
+                "y": _get_subtitle_y(params, video_height, sprite["height"]),
+            }
+        )
+
+    max_size = int(config.app.get("subtitle_cache_max_size_mb", 512)) * 1024 * 1024
+    utils.evict_lru_files(
+        utils.storage_dir("cache_subtitles"), max_size, suffix=".png"
+    )
+    return images
+
+
+def mix_audio(audio_path: str, params: VideoParams, output_dir: str = "") -> str:
+    """
+    Audio pre-mix stage: narration + bgm encoded once to an AAC track in the
+    task dir. Every render of the task muxes this file with a stream copy.
+    The file name is derived from the inputs, so later variants and re-runs
+    of the task reuse it, a random bgm is picked once per task.
+    """
+    output_dir = output_dir or os.path.dirname(audio_path)
+    audio_bitrate = get_encoding_profile(params)["audio_bitrate"]
+    cache_key = utils.md5(
+        f"{os.path.abspath(audio_path)}:{os.path.getmtime(audio_path)}:"
+        f"{params.voice_volume}:{params.bgm_type}:{params.bgm_file}:{params.bgm_volume}:"
+        f"{audio_bitrate}"
+    )
+    mixed_file = os.path.join(output_dir, f"audio-mix-{cache_key[:8]}.m4a")
+    if os.path.exists(mixed_file) and os.path.getsize(mixed_file) > 0:
+        logger.info(f"audio mix already exists: {mixed_file}")
+        return mixed_file
+
+    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+    duration = ffmpeg_utils.probe_video(audio_path)["duration"]
+    logger.info(f"mixing audio, bgm: {bgm_file or 'none'}")
+
+    temp_file = f"{mixed_file}.tmp"
+    try:
+        ffmpeg_render.mix_audio(
+            output_file=temp_file,
+            duration=duration,
+            audio_file=audio_path,
+            voice_volume=params.voice_volume,
+            bgm_file=bgm_file,
+            bgm_volume=params.bgm_volume,
+            audio_bitrate=audio_bitrate,
+        )
+    except Exception as e:
+        # same fallback as before: without the bgm rather than without audio
+        if not bgm_file:
+            raise
+        logger.error(f"failed to add bgm: {str(e)}")
+        ffmpeg_render.mix_audio(
+            output_file=temp_file,
+            duration=duration,
+            audio_file=audio_path,
+            voice_volume=params.voice_volume,
+            audio_bitrate=audio_bitrate,
+        )
+    os.replace(temp_file, mixed_file)
+    return mixed_file
 
 
 def generate_video(
@@ -256,103 +744,491 @@ def generate_video(
     # write into the same directory as the output file
     output_dir = os.path.dirname(output_file)
 
-    font_path = ""
-    if params.subtitle_enabled:
-        if not params.font_name:
-            params.font_name = "STHeitiMedium.ttc"
-        font_path = os.path.join(utils.font_dir(), params.font_name)
-        if os.name == "nt":
-            font_path = font_path.replace("\\", "/")
+    video_clip = VideoFileClip(video_path)
+    text_clips = _create_subtitle_clips(
+        subtitle_path, params, video_width, video_height
+    )
+    if text_clips:
+        video_clip = CompositeVideoClip([video_clip, *text_clips])
 
-        logger.info(f"using font: {font_path}")
+    video_clip.write_videofile(
+        output_file,
+        audio=mix_audio(audio_path, params, output_dir),
+        threads=params.n_threads or 2,
+        logger=None,
+        fps=30,
+        **moviepy_write_args(get_encoding_profile(params)),
+    )
+    video_clip.close()
+    del video_clip
+    logger.success("completed")
 
-    def create_text_clip(subtitle_item):
-        params.font_size = int(params.font_size)
-        params.stroke_width = int(params.stroke_width)
-        phrase = subtitle_item[1]
-        max_width = video_width * 0.9
-        wrapped_txt, txt_height = wrap_text(
-            phrase, max_width=max_width, font=font_path, fontsize=params.font_size
-        )
-        _clip = TextClip(
-            text=wrapped_txt,
-            font=font_path,
-            font_size=params.font_size,
-            color=params.text_fore_color,
-            bg_color=params.text_background_color,
-            stroke_color=params.stroke_color,
-            stroke_width=params.stroke_width,
+
+def _render_segment(
+    timeline: Timeline,
+    segment_file: str,
+    offset: float,
+    subtitle_path: str,
+    params: VideoParams,
+) -> str:
+    """Render a single clip timeline with the subtitles over it, runs in a worker process"""
+    video_clip = _build_video_clip(timeline)
+    end = offset + video_clip.duration
+
+    text_clips = []
+    for clip in _create_subtitle_clips(
+        subtitle_path, params, timeline.width, timeline.height
+    ):
+        if clip.end <= offset or clip.start >= end:
+            continue
+        if clip.start < offset:
+            clip = clip.subclipped(offset - clip.start)
+            clip = clip.with_start(offset)
+        text_clips.append(clip.with_start(clip.start - offset))
+    if text_clips:
+        video_clip = CompositeVideoClip([video_clip, *text_clips]).with_duration(
+            video_clip.duration
         )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.with_start(subtitle_item[0][0])
-        _clip = _clip.with_end(subtitle_item[0][1])
-        _clip = _clip.with_duration(duration)
-        if params.subtitle_position == "bottom":
-            _clip = _clip.with_position(("center", video_height * 0.95 - _clip.h))
-        elif params.subtitle_position == "top":
-            _clip = _clip.with_position(("center", video_height * 0.05))
-        elif params.subtitle_position == "custom":
-            # Ensure the subtitle is fully within the screen bounds
-            margin = 10  # Additional margin, in pixels
-            max_y = video_height - _clip.h - margin
-            min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-            custom_y = max(
-                min_y, min(custom_y, max_y)
-            )  # Constrain the y value within the valid range
-            _clip = _clip.with_position(("center", custom_y))
-        else:  # center
-            _clip = _clip.with_position(("center", "center"))
-        return _clip
 
-    video_clip = VideoFileClip(video_path)
-    audio_clip = AudioFileClip(audio_path).with_effects(
-        [afx.MultiplyVolume(params.voice_volume)]
+    video_clip.write_videofile(
+        segment_file,
+        threads=params.n_threads or 2,
+        logger=None,
+        audio=False,
+        fps=timeline.fps,
+        **moviepy_write_args(get_encoding_profile(params)),
     )
+    video_clip.close()
+    return segment_file
 
-    def make_textclip(text):
-        return TextClip(
-            text=text,
-            font=font_path,
-            font_size=params.font_size,
+
+def _render_segments_moviepy(
+    timeline: Timeline,
+    output_file: str,
+    audio_file: str,
+    subtitle_path: str,
+    params: VideoParams,
+    workers: int,
+) -> str:
+    """
+    moviepy composites frames in python, so the segments are spread over a
+    process pool, then joined with a stream copy concat. Segments whose
+    inputs did not change are taken from the segment cache.
+    """
+    segment_dir = f"{output_file}.segments"
+    os.makedirs(segment_dir, exist_ok=True)
+
+    use_cache = segment_cache.is_enabled()
+    encoding = get_encoding_profile(params)
+    subtitle_images = []
+    if use_cache:
+        subtitle_images = _create_subtitle_images(
+            subtitle_path, params, timeline.width, timeline.height
         )
 
-    if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(
-            subtitles=subtitle_path, encoding="utf-8", make_textclip=make_textclip
+    try:
+        # spawn, not fork: the task runs in a thread of a process that also runs
+        # the shared event loop, the download threads and loguru's handler
+        # lock, a forked child could inherit one of their locks held
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            segment_files = []
+            futures = {}
+            for index, (clip, offset) in enumerate(
+                zip(timeline.clips, timeline.offsets())
+            ):
+                segment_timeline = timeline.with_clips([clip])
+                key = ""
+                if use_cache:
+                    images = ffmpeg_render.overlapping_images(
+                        subtitle_images, offset, offset + clip.duration
+                    )
+                    key = segment_cache.get_key(
+                        segment_timeline, clip, images, encoding, "moviepy"
+                    )
+                    cached_file = segment_cache.get(key)
+                    if cached_file:
+                        segment_files.append(cached_file)
+                        continue
+
+                segment_file = os.path.join(segment_dir, f"segment-{index + 1}.mp4")
+                segment_files.append(segment_file)
+                futures[index] = (
+                    executor.submit(
+                        _render_segment,
+                        segment_timeline,
+                        segment_file,
+                        offset,
+                        subtitle_path,
+                        params,
+                    ),
+                    key,
+                )
+
+            if use_cache:
+                segment_cache.log_stats(
+                    len(timeline.clips) - len(futures), len(timeline.clips)
+                )
+            logger.info(
+                f"rendering {len(futures)} segments with {workers} worker processes"
+            )
+            for index, (future, key) in futures.items():
+                segment_files[index] = future.result()
+                if key:
+                    segment_files[index] = segment_cache.put(segment_files[index], key)
+
+        ffmpeg_render.concat_segments(
+            segment_files=segment_files,
+            output_file=output_file,
+            duration=timeline.duration,
+            audio_file=audio_file,
         )
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
 
-    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
-    if bgm_file:
-        try:
-            bgm_clip = AudioFileClip(bgm_file).with_effects(
-                [
-                    afx.MultiplyVolume(params.bgm_volume),
-                    afx.AudioFadeOut(3),
-                    afx.AudioLoop(duration=video_clip.duration),
-                ]
+    if use_cache and futures:
+        segment_cache.evict()
+    logger.success("completed")
+    return output_file
+
+
+def _render_variant(
+    timeline: Timeline,
+    output_file: str,
+    combined_video_path: str,
+    audio_path: str,
+    subtitle_path: str,
+    params: VideoParams,
+    shared: dict,
+) -> str:
+    """
+    Render one timeline, audio_path is the pre-mixed track (see mix_audio).
+    shared holds what every variant of a batch reuses: the subtitle overlays
+    and, for moviepy, the open decoders and the text clips.
+    """
+    has_subtitles = bool(subtitle_path) and os.path.exists(subtitle_path)
+    encoding = get_encoding_profile(params)
+
+    workers = params.render_workers or 1
+    # some clips can be cut without an encode, see ffmpeg_render.copyable_clips
+    copyable = _can_stream_copy(timeline, encoding["pix_fmt"])
+    # without subtitles nothing is drawn over the copyable clips, so they
+    # need no encode. With the segment cache the ffmpeg backend renders
+    # segments, so edits re-encode only the changed ones.
+    if (
+        workers > 1
+        or (not has_subtitles and copyable)
+        or (
+            params.render_backend == RenderBackend.ffmpeg.value
+            and segment_cache.is_enabled()
+        )
+    ):
+        if combined_video_path and has_subtitles:
+            ffmpeg_render.render_segments(
+                timeline=timeline,
+                output_file=combined_video_path,
+                threads=params.n_threads or 2,
+                workers=workers,
+                encoding=encoding,
+                stream_copy=copyable,
             )
-            audio_clip = CompositeAudioClip([audio_clip, bgm_clip])
-        except Exception as e:
-            logger.error(f"failed to add bgm: {str(e)}")
+        if params.render_backend == RenderBackend.ffmpeg.value or not has_subtitles:
+            ffmpeg_render.render_segments(
+                timeline=timeline,
+                output_file=output_file,
+                audio_file=audio_path,
+                subtitle_images=shared["subtitle_images"],
+                threads=params.n_threads or 2,
+                workers=workers,
+                encoding=encoding,
+                stream_copy=copyable,
+            )
+        else:
+            _render_segments_moviepy(
+                timeline=timeline,
+                output_file=output_file,
+                audio_file=audio_path,
+                subtitle_path=subtitle_path,
+                params=params,
+                workers=workers,
+            )
+        if combined_video_path and not has_subtitles:
+            ffmpeg_utils.run_ffmpeg(
+                ["-i", output_file, "-map", "0:v", "-c", "copy", combined_video_path]
+            )
+        return output_file
+
+    if params.render_backend == RenderBackend.ffmpeg.value:
+        return ffmpeg_render.render_video(
+            timeline=timeline,
+            output_file=output_file,
+            audio_file=audio_path,
+            subtitle_images=shared["subtitle_images"],
+            combined_video_path=combined_video_path,
+            threads=params.n_threads or 2,
+            encoding=encoding,
+        )
+
+    if combined_video_path and copyable:
+        ffmpeg_render.render_segments(
+            timeline=timeline,
+            output_file=combined_video_path,
+            threads=params.n_threads or 2,
+            encoding=encoding,
+            stream_copy=True,
+        )
+        combined_video_path = ""
+
+    video_clip = _build_video_clip(timeline, sources=shared["sources"])
+
+    if combined_video_path:
+        logger.info(f"writing combined video: {combined_video_path}")
+        video_clip.write_videofile(
+            filename=combined_video_path,
+            threads=params.n_threads or 2,
+            logger=None,
+            audio=False,
+            fps=timeline.fps,
+            **moviepy_write_args(encoding),
+        )
+
+    if shared.get("text_clips") is None:
+        shared["text_clips"] = _create_subtitle_clips(
+            subtitle_path, params, timeline.width, timeline.height
+        )
+    if shared["text_clips"]:
+        video_clip = CompositeVideoClip([video_clip, *shared["text_clips"]])
 
-    video_clip = video_clip.with_audio(audio_clip)
     video_clip.write_videofile(
         output_file,
-        audio_codec="aac",
-        temp_audiofile_path=output_dir,
+        audio=audio_path,
         threads=params.n_threads or 2,
         logger=None,
-        fps=30,
+        fps=timeline.fps,
+        **moviepy_write_args(encoding),
     )
-    video_clip.close()
+    # the decoders are shared, render_videos closes them
     del video_clip
+    return output_file
+
+
+def _get_render_format(params: VideoParams):
+    """Output width, height and fps, the preview mode scales the short side down to preview_resolution"""
+    video_width, video_height = VideoAspect(params.video_aspect).to_resolution()
+    if params.render_mode != RenderMode.preview.value:
+        return video_width, video_height, 30
+
+    scale = int(config.app.get("preview_resolution", 360)) / min(
+        video_width, video_height
+    )
+    # libx264 needs even dimensions
+    video_width = int(video_width * scale) // 2 * 2
+    video_height = int(video_height * scale) // 2 * 2
+    return video_width, video_height, int(config.app.get("preview_fps", 15))
+
+
+def _get_preview_params(params: VideoParams) -> VideoParams:
+    """Same subtitle layout at the preview resolution, encoded with the draft profile"""
+    video_width, _ = VideoAspect(params.video_aspect).to_resolution()
+    preview_width, _, _ = _get_render_format(params)
+    scale = preview_width / video_width
+    # the stroke is drawn in whole pixels, keep at least one if there is any
+    stroke_width = round(params.stroke_width * scale)
+    if params.stroke_width > 0:
+        stroke_width = max(stroke_width, 1)
+    return params.model_copy(
+        update={
+            "font_size": max(int(int(params.font_size) * scale), 1),
+            "stroke_width": stroke_width,
+            "encoding_profile": "draft",
+        }
+    )
+
+
+def get_timeline_path(output_file: str) -> str:
+    """The timeline of final-1.mp4 is saved as final-1.timeline.json"""
+    return f"{os.path.splitext(output_file)[0]}.timeline.json"
+
+
+def plan_timelines(
+    video_paths: List[str],
+    audio_path: str,
+    params: VideoParams,
+    count: int = 1,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    stream_copy: bool = False,
+) -> List[Timeline]:
+    """
+    One timeline per output. With params.video_seed timeline N is seeded with
+    video_seed + N, so the same seed cuts the materials the same way again.
+    stream_copy is passed on to _plan_timeline.
+    """
+    video_width, video_height, fps = _get_render_format(params)
+    audio_duration = ffmpeg_utils.probe_video(audio_path)["duration"]
+    probes = _probe_videos(video_paths)
+
+    timelines = []
+    for index in range(count):
+        seed = None
+        if params.video_seed is not None:
+            seed = params.video_seed + index
+        timelines.append(
+            _plan_timeline(
+                video_paths=video_paths,
+                audio_duration=audio_duration,
+                video_width=video_width,
+                video_height=video_height,
+                fps=fps,
+                video_concat_mode=video_concat_mode,
+                video_transition_mode=params.video_transition_mode,
+                max_clip_duration=params.video_clip_duration,
+                probes=probes,
+                seed=seed,
+                stream_copy=stream_copy,
+            )
+        )
+    return timelines
+
+
+def render_videos(
+    video_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    output_files: List[str],
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    combined_video_paths: List[str] = None,
+    timelines: List[Timeline] = None,
+    progress: Callable[[int, int], None] = None,
+) -> List[str]:
+    """
+    Batch render of several variants of the same task. The sources are probed
+    once, the audio is mixed once and the subtitle overlays are prepared once,
+    then every output renders its own timeline (see plan_timelines, or pass
+    saved timelines to render them again, a preview's timelines are fitted to
+    the final format). Each timeline is saved next to its output as
+    <name>.timeline.json.
+
+    The ffmpeg backend runs the variants concurrently, each one is a separate
+    ffmpeg process. moviepy decodes in the python process and its readers are
+    not thread safe, so its variants are rendered one after another, sharing
+    the open decoders and the text clips.
+
+    progress is called with the number of finished videos and the total each
+    time a video is done.
+    """
+    if timelines is None:
+        timelines = plan_timelines(
+            video_paths=video_paths,
+            audio_path=audio_path,
+            params=params,
+            count=len(output_files),
+            video_concat_mode=video_concat_mode,
+            stream_copy=not (subtitle_path and os.path.exists(subtitle_path)),
+        )
+    else:
+        timelines = [
+            _fit_timeline(timeline, *_get_render_format(params))
+            for timeline in timelines
+        ]
+    if params.render_mode == RenderMode.preview.value:
+        params = _get_preview_params(params)
+    combined_video_paths = combined_video_paths or [""] * len(output_files)
+
+    video_width, video_height = timelines[0].width, timelines[0].height
+    logger.info(
+        f"start, video size: {video_width} x {video_height}, fps: {timelines[0].fps}"
+    )
+    logger.info(f"  ① videos: {len(video_paths)}")
+    logger.info(f"  ② audio: {audio_path}")
+    logger.info(f"  ③ subtitle: {subtitle_path}")
+    logger.info(f"  ④ outputs: {output_files}")
+
+    for timeline, output_file in zip(timelines, output_files):
+        timeline.save(get_timeline_path(output_file))
+
+    output_dir = os.path.dirname(output_files[0])
+    mixed_audio = mix_audio(audio_path, params, output_dir)
+    shared = {
+        "subtitle_images": _create_subtitle_images(
+            subtitle_path, params, video_width, video_height
+        )
+        if params.render_backend == RenderBackend.ffmpeg.value
+        else [],
+        "sources": {},
+    }
+
+    jobs = [
+        (
+            timeline,
+            output_file,
+            combined_video_path,
+            mixed_audio,
+            subtitle_path,
+            params,
+            shared,
+        )
+        for timeline, output_file, combined_video_path in zip(
+            timelines, output_files, combined_video_paths
+        )
+    ]
+
+    try:
+        if params.render_backend == RenderBackend.ffmpeg.value and len(jobs) > 1:
+            logger.info(f"rendering {len(jobs)} videos concurrently")
+            results = [""] * len(jobs)
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                futures = {
+                    executor.submit(_render_variant, *job): index
+                    for index, job in enumerate(jobs)
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    results[futures[future]] = future.result()
+                    if progress:
+                        progress(done, len(jobs))
+        else:
+            results = []
+            for job in jobs:
+                logger.info(f"rendering video: {job[1]}")
+                results.append(_render_variant(*job))
+                if progress:
+                    progress(len(results), len(jobs))
+    finally:
+        for source in shared["sources"].values():
+            source.close()
+
     logger.success("completed")
+    return results
+
+
+def render_video(
+    video_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    combined_video_path: str = "",
+) -> str:
+    """
+    Single-pass render: the clip timeline, the subtitle overlays and the mixed
+    audio are composed into one clip and encoded once, instead of encoding a
+    combined-N.mp4 first and decoding it again in generate_video.
+
+    The intermediate combined video is only written when combined_video_path
+    is given. params.render_backend selects moviepy frame compositing or a
+    single ffmpeg filter graph; both render the same timeline.
+    """
+    return render_videos(
+        video_paths=video_paths,
+        audio_path=audio_path,
+        subtitle_path=subtitle_path,
+        output_files=[output_file],
+        params=params,
+        video_concat_mode=video_concat_mode,
+        combined_video_paths=[combined_video_path],
+    )[0]
 
 
 def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
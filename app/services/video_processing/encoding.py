@@ -0,0 +1,131 @@
+from typing import List
+
+from app.config import config
+
+# x264 settings per named profile, gop is in frames
+ENCODING_PROFILES = {
+    # fast turnaround for previews, quality is secondary
+    "draft": {
+        "preset": "ultrafast",
+        "crf": 28,
+        "tune": "",
+        "gop": 60,
+        "pix_fmt": "yuv420p",
+        "audio_bitrate": "128k",
+    },
+    # the libx264 defaults moviepy has always used
+    "standard": {
+        "preset": "medium",
+        "crf": 23,
+        "tune": "",
+        "gop": 250,
+        "pix_fmt": "yuv420p",
+        "audio_bitrate": "192k",
+    },
+    # publish renders
+    "archive": {
+        "preset": "slow",
+        "crf": 18,
+        "tune": "film",
+        "gop": 250,
+        "pix_fmt": "yuv420p",
+        "audio_bitrate": "256k",
+    },
+}
+
+# VideoParams field => profile key, a field that is set overrides the profile
+_PARAM_OVERRIDES = {
+    "video_preset": "preset",
+    "video_crf": "crf",
+    "video_tune": "tune",
+    "video_gop": "gop",
+    "video_pix_fmt": "pix_fmt",
+    "audio_bitrate": "audio_bitrate",
+}
+
+
+def get_encoding_profile(params=None) -> dict:
+    """
+    Resolve the encoding settings of a task: the built-in profile, then the
+    [encoding_profiles.<name>] table of config.toml, then the per task
+    overrides of VideoParams. Unknown names fall back to "standard".
+    """
+    name = getattr(params, "encoding_profile", "") or "standard"
+    configured = config.encoding_profiles.get(name, {})
+    if name not in ENCODING_PROFILES and not configured:
+        name = "standard"
+
+    profile = {
+        **ENCODING_PROFILES["standard"],
+        **ENCODING_PROFILES.get(name, {}),
+        **configured,
+    }
+    for field, key in _PARAM_OVERRIDES.items():
+        value = getattr(params, field, None)
+        if value is not None and value != "":
+            profile[key] = value
+    profile["name"] = name
+    return profile
+
+
+def get_normalized_profile(fps: int) -> dict:
+    """
+    The settings normalize_video encodes materials with: x264 defaults and a
+    one second GOP. Anything encoded with them at the same size and fps has
+    the same SPS/PPS, so it can be joined with stream copies of normalized clips.
+    """
+    return {
+        "name": "normalized",
+        "preset": "medium",
+        "crf": 23,
+        "tune": "",
+        "gop": fps,
+        "keyint_min": fps,
+        "sc_threshold": 0,
+        "pix_fmt": "yuv420p",
+    }
+
+
+def ffmpeg_video_args(profile: dict, fps: int, threads: int) -> List[str]:
+    args = [
+        "-c:v",
+        "libx264",
+        "-preset",
+        str(profile["preset"]),
+        "-crf",
+        str(profile["crf"]),
+    ]
+    if profile.get("tune"):
+        args += ["-tune", str(profile["tune"])]
+    if profile.get("gop"):
+        args += ["-g", str(profile["gop"])]
+    if profile.get("keyint_min"):
+        args += ["-keyint_min", str(profile["keyint_min"])]
+    if "sc_threshold" in profile:
+        args += ["-sc_threshold", str(profile["sc_threshold"])]
+    args += [
+        "-pix_fmt",
+        str(profile["pix_fmt"]),
+        "-r",
+        str(fps),
+        "-threads",
+        str(threads or 2),
+    ]
+    return args
+
+
+def moviepy_write_args(profile: dict) -> dict:
+    """
+    Keyword arguments for VideoClip.write_videofile. moviepy always encodes
+    libx264 output as yuv420p, so pix_fmt only applies to the ffmpeg backend.
+    """
+    ffmpeg_params = ["-crf", str(profile["crf"])]
+    if profile.get("tune"):
+        ffmpeg_params += ["-tune", str(profile["tune"])]
+    if profile.get("gop"):
+        ffmpeg_params += ["-g", str(profile["gop"])]
+    return {
+        "codec": "libx264",
+        "preset": str(profile["preset"]),
+        "ffmpeg_params": ffmpeg_params,
+    }
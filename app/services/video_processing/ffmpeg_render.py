@@ -0,0 +1,581 @@
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from loguru import logger
+
+from app.models.timeline import Timeline, TimelineClip
+from app.services.video_processing import ffmpeg_utils, segment_cache
+from app.services.video_processing.encoding import (
+    ffmpeg_video_args,
+    get_encoding_profile,
+    get_normalized_profile,
+)
+
+# the moviepy effects in app/services/utils/video_effects.py all run for 1 second
+TRANSITION_DURATION = 1
+
+
+def _slide_expressions(transition: str, side: str, duration: float):
+    """
+    Overlay x/y expressions equivalent to moviepy's vfx.SlideIn / vfx.SlideOut,
+    `t` is the segment local time.
+    """
+    td = TRANSITION_DURATION
+    if transition == "SlideIn":
+        progress = f"(t/{td}-1)"
+        moves = {
+            "left": (f"min(0,W*{progress})", "0"),
+            "right": (f"max(0,-W*{progress})", "0"),
+            "top": ("0", f"min(0,H*{progress})"),
+            "bottom": ("0", f"max(0,-H*{progress})"),
+        }
+    else:
+        start = max(duration - td, 0)
+        progress = f"({start}-t)/{td}"
+        moves = {
+            "left": (f"min(0,W*{progress})", "0"),
+            "right": (f"max(0,-W*{progress})", "0"),
+            "top": ("0", f"min(0,H*{progress})"),
+            "bottom": ("0", f"max(0,-H*{progress})"),
+        }
+    return moves.get(side, moves["left"])
+
+
+def _segment_filters(
+    index: int, clip: TimelineClip, video_width: int, video_height: int, fps: int
+) -> List[str]:
+    duration = clip.duration
+    new_width, new_height = clip.scaled_width, clip.scaled_height
+
+    chain = [f"fps={fps}"]
+    if (new_width, new_height) != (clip.width, clip.height):
+        chain.append(f"scale={new_width}:{new_height}")
+    chain.append("setsar=1")
+    if (new_width, new_height) != (video_width, video_height):
+        chain.append(
+            f"pad={video_width}:{video_height}:{clip.x}:{clip.y}:color=black"
+        )
+    chain.append("format=yuv420p")
+    if clip.loops > 1:
+        frames = math.ceil((clip.end - clip.start) * fps)
+        chain.append(f"loop=loop={clip.loops - 1}:size={frames}:start=0")
+    chain.append(f"trim=duration={duration:.6f}")
+    chain.append("setpts=PTS-STARTPTS")
+
+    transition = clip.transition
+    if transition == "FadeIn":
+        chain.append(f"fade=t=in:st=0:d={TRANSITION_DURATION}")
+    elif transition == "FadeOut":
+        start = max(duration - TRANSITION_DURATION, 0)
+        chain.append(f"fade=t=out:st={start:.6f}:d={TRANSITION_DURATION}")
+
+    if transition not in ("SlideIn", "SlideOut"):
+        return [f"[{index}:v]{','.join(chain)}[v{index}]"]
+
+    x, y = _slide_expressions(transition, clip.side, duration)
+    return [
+        f"[{index}:v]{','.join(chain)}[s{index}]",
+        f"color=c=black:s={video_width}x{video_height}:r={fps}:d={duration:.6f}[bg{index}]",
+        f"[bg{index}][s{index}]overlay=x='{x}':y='{y}':eval=frame:shortest=1[v{index}]",
+    ]
+
+
+def _audio_graph(
+    input_index: int,
+    duration: float,
+    audio_file: str = "",
+    voice_volume: float = 1.0,
+    bgm_file: str = "",
+    bgm_volume: float = 0.2,
+):
+    """
+    Inputs and filters for the narration + bgm mix: the bgm fades out over
+    its last 3 seconds and loops for the whole duration.
+    Returns (inputs, filters, output label).
+    """
+    inputs, filters = [], []
+    if not audio_file:
+        return inputs, filters, ""
+
+    inputs += ["-i", audio_file]
+    filters.append(f"[{input_index}:a]volume={voice_volume}[voice]")
+    if not bgm_file:
+        return inputs, filters, "voice"
+
+    bgm_duration = ffmpeg_utils.probe_video(bgm_file)["duration"]
+    inputs += ["-i", bgm_file]
+    filters.append(
+        f"[{input_index + 1}:a]volume={bgm_volume},"
+        f"afade=t=out:st={max(bgm_duration - 3, 0):.3f}:d=3,"
+        f"aloop=loop=-1:size=2147483647,"
+        f"atrim=duration={duration:.6f}[bgm]"
+    )
+    filters.append(
+        "[voice][bgm]amix=inputs=2:duration=longest:dropout_transition=0:normalize=0[mix]"
+    )
+    return inputs, filters, "mix"
+
+
+def mix_audio(
+    output_file: str,
+    duration: float,
+    audio_file: str,
+    voice_volume: float = 1.0,
+    bgm_file: str = "",
+    bgm_volume: float = 0.2,
+    audio_bitrate: str = "192k",
+) -> str:
+    """Encode the narration + bgm mix to a single AAC track that renders mux without re-encoding"""
+    inputs, filters, label = _audio_graph(
+        input_index=0,
+        duration=duration,
+        audio_file=audio_file,
+        voice_volume=voice_volume,
+        bgm_file=bgm_file,
+        bgm_volume=bgm_volume,
+    )
+    ffmpeg_utils.run_ffmpeg(
+        [
+            *inputs,
+            "-filter_complex",
+            ";".join(filters),
+            "-map",
+            f"[{label}]",
+            "-c:a",
+            "aac",
+            "-b:a",
+            audio_bitrate,
+            "-t",
+            f"{duration:.6f}",
+            "-f",
+            "mp4",
+            output_file,
+        ]
+    )
+    return output_file
+
+
+def can_stream_copy(
+    clip: TimelineClip,
+    video_width: int,
+    video_height: int,
+    fps: int,
+    pix_fmt: str = "yuv420p",
+) -> bool:
+    """
+    A clip can be copied as-is when it is already h264 in the target pixel
+    format, resolution and fps, and it is neither looped nor transitioned.
+    """
+    return (
+        clip.codec == "h264"
+        and clip.pix_fmt == pix_fmt
+        and (clip.width, clip.height) == (video_width, video_height)
+        and abs(clip.fps - fps) < 0.01
+        and clip.loops == 1
+        and not clip.transition
+    )
+
+
+def _on_keyframe(time: float, keyframes: List[float], fps: int) -> bool:
+    return any(abs(keyframe - time) < 0.5 / fps for keyframe in keyframes)
+
+
+def copyable_clips(timeline: Timeline, pix_fmt: str = "yuv420p") -> List[bool]:
+    """
+    Which clips can be stream copied frame exact: the clip passes
+    can_stream_copy and runs from a keyframe to a keyframe (or the end of its
+    source), so the copy holds exactly its frames. The concat demuxer writes
+    only the codec headers of the first segment, so all copied clips have to
+    share one set of SPS/PPS, otherwise none is copied.
+
+    render_segments encodes the other clips with the normalize_video settings,
+    which gives the same headers as normalized materials. So in practice the
+    copies pay off for normalized materials (normalize_materials); raw
+    downloads from different uploads have headers of their own and are
+    re-encoded as a whole.
+    """
+    fps = timeline.fps
+    flags = []
+    headers = set()
+    for clip in timeline.clips:
+        copyable = can_stream_copy(
+            clip, timeline.width, timeline.height, fps, pix_fmt
+        ) and abs(clip.end - clip.start - clip.duration) < 0.5 / fps
+        if copyable:
+            try:
+                info = ffmpeg_utils.get_keyframe_info(clip.path)
+            except Exception as e:
+                logger.warning(f"failed to probe keyframes: {clip.path} => {str(e)}")
+                info = {"keyframes": [], "duration": 0}
+            keyframes = info["keyframes"]
+            copyable = _on_keyframe(clip.start, keyframes, fps) and (
+                _on_keyframe(clip.end, keyframes, fps)
+                or clip.end >= info["duration"] - 0.5 / fps
+            )
+            if copyable:
+                headers.add(info["stream_headers"])
+        flags.append(copyable)
+    if len(headers) > 1:
+        return [False] * len(flags)
+    return flags
+
+
+def _is_exact_copy(segment_file: str, frames: int, fps: int) -> bool:
+    """The copied segment holds `frames` frames, one every 1/fps, no gap"""
+    result = ffmpeg_utils.run_ffmpeg(
+        ["-i", segment_file, "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"]
+    )
+    time_base = 0
+    pts = []
+    for line in result.stdout.decode("utf-8", errors="ignore").splitlines():
+        if line.startswith("#tb 0:"):
+            num, den = line.split(":")[1].strip().split("/")
+            time_base = int(num) / int(den)
+        elif line and not line.startswith("#"):
+            pts.append(int(line.split(",")[2]) * time_base)
+    pts.sort()
+    return len(pts) == frames and all(
+        abs(b - a - 1 / fps) < 0.25 / fps for a, b in zip(pts, pts[1:])
+    )
+
+
+def _can_concat(
+    timeline: Timeline, segment_files: List[str], copies: List[bool]
+) -> bool:
+    """Every copy is frame exact and every segment has the headers of the copies"""
+    fps = timeline.fps
+    headers = set()
+    for clip, segment_file, copied in zip(timeline.clips, segment_files, copies):
+        if copied and not _is_exact_copy(segment_file, round(clip.duration * fps), fps):
+            return False
+        headers.add(ffmpeg_utils.probe_stream_headers(segment_file))
+    return len(headers) == 1
+
+
+def overlapping_images(
+    subtitle_images: List[dict], start: float, end: float
+) -> List[dict]:
+    """Subtitle images visible in [start, end), with times relative to start"""
+    images = []
+    for image in subtitle_images or []:
+        if image["end"] <= start or image["start"] >= end:
+            continue
+        images.append(
+            {
+                **image,
+                "start": max(image["start"] - start, 0),
+                "end": min(image["end"], end) - start,
+            }
+        )
+    return images
+
+
+def _overlay_filters(
+    video_label: str, subtitle_images: List[dict], input_index: int
+):
+    """Chain one overlay per subtitle image, returns (filters, output label)"""
+    filters = []
+    for n, image in enumerate(subtitle_images):
+        filters.append(
+            f"[{video_label}][{input_index + n}:v]overlay=x={int(image['x'])}:y={int(image['y'])}"
+            f":enable='between(t,{image['start']:.3f},{image['end']:.3f})'[sub{n}]"
+        )
+        video_label = f"sub{n}"
+    return filters, video_label
+
+
+def _segment_args(
+    clip: TimelineClip,
+    segment_file: str,
+    video_width: int,
+    video_height: int,
+    fps: int,
+    threads: int,
+    subtitle_images: List[dict] = None,
+    encoding: dict = None,
+    stream_copy: bool = False,
+) -> List[str]:
+    encoding = encoding or get_encoding_profile()
+    if stream_copy:
+        # the clip starts on a keyframe (see copyable_clips), count frames
+        # instead of -t so the copy ends exactly on the next one
+        return [
+            "-ss",
+            f"{clip.start:.6f}",
+            "-i",
+            clip.path,
+            "-frames:v",
+            str(round(clip.duration * fps)),
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-avoid_negative_ts",
+            "make_zero",
+            segment_file,
+        ]
+
+    inputs = [
+        "-ss",
+        f"{clip.start:.6f}",
+        "-t",
+        f"{clip.end - clip.start:.6f}",
+        "-i",
+        clip.path,
+    ]
+    filters = _segment_filters(0, clip, video_width, video_height, fps)
+    for image in subtitle_images or []:
+        inputs += ["-i", image["path"]]
+    overlays, video_label = _overlay_filters("v0", subtitle_images or [], 1)
+    filters += overlays
+    return [
+        *inputs,
+        "-filter_complex",
+        ";".join(filters),
+        "-map",
+        f"[{video_label}]",
+        *ffmpeg_video_args(encoding, fps, threads),
+        "-t",
+        f"{clip.duration:.6f}",
+        segment_file,
+    ]
+
+
+def concat_segments(
+    segment_files: List[str],
+    output_file: str,
+    duration: float,
+    audio_file: str = "",
+) -> str:
+    """Join rendered segments with the concat demuxer and mux in the mixed audio, both stream copied"""
+    concat_file = f"{output_file}.concat.txt"
+    with open(concat_file, "w", encoding="utf-8") as f:
+        for segment_file in segment_files:
+            segment_file = os.path.abspath(segment_file).replace("\\", "/")
+            f.write(f"file '{segment_file}'\n")
+
+    args = ["-f", "concat", "-safe", "0", "-i", concat_file]
+    if audio_file:
+        args += ["-i", audio_file]
+    args += ["-map", "0:v", "-c:v", "copy"]
+    if audio_file:
+        args += ["-map", "1:a", "-c:a", "copy"]
+    args += ["-t", f"{duration:.6f}", "-movflags", "+faststart", output_file]
+    try:
+        ffmpeg_utils.run_ffmpeg(args)
+    finally:
+        os.remove(concat_file)
+    return output_file
+
+
+def render_segments(
+    timeline: Timeline,
+    output_file: str,
+    audio_file: str = "",
+    subtitle_images: List[dict] = None,
+    threads: int = 2,
+    workers: int = 1,
+    encoding: dict = None,
+    stream_copy: bool = False,
+) -> str:
+    """
+    Render the timeline as one segment per clip, then join the segments with
+    the concat demuxer without another encode.
+
+    Segments are independent (transitions belong to their clip, subtitles are
+    split at segment boundaries), so up to `workers` ffmpeg processes render
+    them at the same time. With stream_copy the clips copyable_clips allows
+    and without a subtitle over them are cut from their source without
+    re-encoding, the others are encoded with the normalize_video settings so
+    their headers match the copies. If a copy is not frame exact or the
+    headers still differ, the whole timeline is encoded with `encoding`.
+    Encoded segments are kept in the segment cache, keyed by their inputs,
+    so a re-render after an edit only encodes the segments that changed.
+    """
+    if not timeline.clips:
+        raise ValueError("the timeline is empty")
+
+    encoding = encoding or get_encoding_profile()
+    use_cache = segment_cache.is_enabled()
+    segment_dir = f"{output_file}.segments"
+    os.makedirs(segment_dir, exist_ok=True)
+
+    offsets = timeline.offsets()
+    images = [
+        overlapping_images(subtitle_images, offset, offset + clip.duration)
+        for clip, offset in zip(timeline.clips, offsets)
+    ]
+    copies = [False] * len(timeline.clips)
+    if stream_copy:
+        copies = [
+            copyable and not clip_images
+            for copyable, clip_images in zip(
+                copyable_clips(timeline, encoding["pix_fmt"]), images
+            )
+        ]
+    segment_encoding = encoding
+    if any(copies):
+        segment_encoding = get_normalized_profile(timeline.fps)
+
+    segment_files = []
+    jobs = []
+    cache_keys = {}
+    for index, clip in enumerate(timeline.clips):
+        segment_file = os.path.join(segment_dir, f"segment-{index + 1}.mp4")
+        args = _segment_args(
+            clip,
+            segment_file,
+            timeline.width,
+            timeline.height,
+            timeline.fps,
+            threads,
+            images[index],
+            segment_encoding,
+            copies[index],
+        )
+        # stream copies are cheaper to redo than to store twice
+        if use_cache and not copies[index]:
+            key = segment_cache.get_key(
+                timeline, clip, images[index], segment_encoding, "ffmpeg"
+            )
+            cached_file = segment_cache.get(key)
+            if cached_file:
+                segment_files.append(cached_file)
+                continue
+            cache_keys[index] = key
+        segment_files.append(segment_file)
+        jobs.append(args)
+
+    copied = sum(copies)
+    if use_cache:
+        segment_cache.log_stats(
+            len(timeline.clips) - len(jobs), len(timeline.clips) - copied
+        )
+    logger.info(
+        f"rendering {len(jobs)} segments with {workers} workers, stream copy: {copied}"
+    )
+    try:
+        # every job is its own ffmpeg process, threads are enough to drive them
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            list(executor.map(ffmpeg_utils.run_ffmpeg, jobs))
+
+        if copied and not _can_concat(timeline, segment_files, copies):
+            logger.warning(
+                "stream copied segments do not join with the encoded ones, re-encoding"
+            )
+            shutil.rmtree(segment_dir, ignore_errors=True)
+            return render_segments(
+                timeline=timeline,
+                output_file=output_file,
+                audio_file=audio_file,
+                subtitle_images=subtitle_images,
+                threads=threads,
+                workers=workers,
+                encoding=encoding,
+            )
+
+        for index, key in cache_keys.items():
+            segment_files[index] = segment_cache.put(segment_files[index], key)
+
+        concat_segments(
+            segment_files=segment_files,
+            output_file=output_file,
+            duration=timeline.duration,
+            audio_file=audio_file,
+        )
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+    if cache_keys:
+        segment_cache.evict()
+    logger.success(f"completed: {output_file}")
+    return output_file
+
+
+def render_video(
+    timeline: Timeline,
+    output_file: str,
+    audio_file: str = "",
+    subtitle_images: List[dict] = None,
+    combined_video_path: str = "",
+    threads: int = 2,
+    encoding: dict = None,
+) -> str:
+    """
+    Render the timeline with a single ffmpeg filter_complex graph:
+    per clip trim/scale/pad/fade, concat, overlay of the pre-rendered subtitle
+    images, then the mixed audio (see mix_audio) is muxed in as-is.
+    No frame passes through python.
+
+    subtitle_images: [{"path": png, "start": s, "end": e, "x": x, "y": y}]
+    """
+    if not timeline.clips:
+        raise ValueError("the timeline is empty")
+
+    fps = timeline.fps
+    inputs = []
+    filters = []
+    for index, clip in enumerate(timeline.clips):
+        inputs += [
+            "-ss",
+            f"{clip.start:.6f}",
+            "-t",
+            f"{clip.end - clip.start:.6f}",
+            "-i",
+            clip.path,
+        ]
+        filters += _segment_filters(
+            index, clip, timeline.width, timeline.height, fps
+        )
+
+    video_duration = timeline.duration
+    clip_count = len(timeline.clips)
+    segments = "".join(f"[v{index}]" for index in range(clip_count))
+    filters.append(f"{segments}concat=n={clip_count}:v=1:a=0[vcat]")
+
+    video_label = "vcat"
+    if combined_video_path:
+        filters.append("[vcat]split=2[vmain][vcomb]")
+        video_label = "vmain"
+
+    input_index = clip_count
+    for image in subtitle_images or []:
+        inputs += ["-i", image["path"]]
+    overlays, video_label = _overlay_filters(
+        video_label, subtitle_images or [], input_index
+    )
+    filters += overlays
+    input_index += len(subtitle_images or [])
+    if audio_file:
+        inputs += ["-i", audio_file]
+
+    output_dir = os.path.dirname(output_file)
+    filter_script = f"{output_file}.filter.txt"
+    with open(filter_script, "w", encoding="utf-8") as f:
+        f.write(";\n".join(filters))
+
+    encoding = encoding or get_encoding_profile()
+    video_codec = ffmpeg_video_args(encoding, fps, threads)
+    args = [*inputs, "-filter_complex_script", filter_script]
+    args += ["-map", f"[{video_label}]"]
+    if audio_file:
+        args += ["-map", f"{input_index}:a", "-c:a", "copy"]
+    args += [*video_codec, "-t", f"{video_duration:.6f}"]
+    args += ["-movflags", "+faststart", output_file]
+    if combined_video_path:
+        args += ["-map", "[vcomb]", "-an", *video_codec, combined_video_path]
+
+    logger.info(f"rendering with ffmpeg, segments: {clip_count}")
+    try:
+        ffmpeg_utils.run_ffmpeg(args, cwd=output_dir or None)
+    finally:
+        try:
+            os.remove(filter_script)
+        except Exception:
+            pass
+
+    logger.success(f"completed: {output_file}")
+    return output_file
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+from typing import List
+
+from loguru import logger
+
+# probe results are kept next to the video, see get_video_info
+META_SUFFIX = ".meta.json"
+
+
+def get_ffmpeg_binary() -> str:
+    # moviepy resolves IMAGEIO_FFMPEG_EXE / FFMPEG_BINARY (see config.ffmpeg_path)
+    from moviepy.config import FFMPEG_BINARY
+
+    return FFMPEG_BINARY
+
+
+def run_ffmpeg(args: List[str], cwd: str = None):
+    cmd = [get_ffmpeg_binary(), "-hide_banner", "-y", *args]
+    logger.debug(f"running ffmpeg: {subprocess.list2cmdline(cmd)}")
+    result = subprocess.run(
+        cmd,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+    )
+    if result.returncode != 0:
+        stderr = result.stderr.decode("utf-8", errors="ignore")
+        raise RuntimeError(f"ffmpeg failed ({result.returncode}): {stderr[-2000:]}")
+    return result
+
+
+def probe_video(video_path: str) -> dict:
+    """
+    Read duration, fps, resolution and codec from the container header.
+    `ffmpeg -i` without an output only parses the header, no frame is decoded.
+    """
+    if not os.path.isfile(video_path):
+        raise FileNotFoundError(video_path)
+
+    cmd = [get_ffmpeg_binary(), "-hide_banner", "-i", video_path]
+    result = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL
+    )
+    output = result.stderr.decode("utf-8", errors="ignore")
+
+    info = {
+        "duration": 0.0,
+        "fps": 0.0,
+        "width": 0,
+        "height": 0,
+        "codec": "",
+        "pix_fmt": "",
+    }
+
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if match:
+        hours, minutes, seconds = match.groups()
+        info["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    for line in output.splitlines():
+        if "Stream #" not in line or "Video:" not in line:
+            continue
+        match = re.search(r"Video: (\w+)", line)
+        if match:
+            info["codec"] = match.group(1)
+        match = re.search(r"Video: [^,]+, (\w+)", line)
+        if match:
+            info["pix_fmt"] = match.group(1)
+        match = re.search(r", (\d{2,5})x(\d{2,5})", line)
+        if match:
+            info["width"], info["height"] = int(match.group(1)), int(match.group(2))
+        match = re.search(r", ([\d.]+) fps", line) or re.search(
+            r", ([\d.]+) tbr", line
+        )
+        if match:
+            info["fps"] = float(match.group(1))
+        break
+
+    # phone footage is often stored landscape with a rotation flag
+    match = re.search(r"rotation of (-?[\d.]+) degrees", output)
+    if match and abs(float(match.group(1))) % 180 == 90:
+        info["width"], info["height"] = info["height"], info["width"]
+
+    return info
+
+
+def is_valid_video(info: dict) -> bool:
+    return info["duration"] > 0 and info["fps"] > 0
+
+
+def save_video_info(video_path: str, info: dict):
+    meta_path = f"{video_path}{META_SUFFIX}"
+    try:
+        data = {"size": os.path.getsize(video_path), "info": info}
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(f"{meta_path}.tmp", meta_path)
+    except OSError as e:
+        logger.debug(f"failed to save video info: {meta_path} => {str(e)}")
+
+
+def get_video_info(video_path: str) -> dict:
+    """
+    probe_video with a sidecar cache: the result is stored in
+    <video>.meta.json and reused while the file size is unchanged, so cached
+    materials are validated and planned without starting ffmpeg.
+    """
+    size = os.path.getsize(video_path)
+    try:
+        with open(f"{video_path}{META_SUFFIX}", "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["size"] == size:
+            return data["info"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    info = probe_video(video_path)
+    save_video_info(video_path, info)
+    return info
+
+
+def probe_stream_headers(video_path: str) -> str:
+    """Hash of the h264 headers (SPS/PPS) of the first video stream, read from its first packet"""
+    result = run_ffmpeg(
+        [
+            "-i",
+            video_path,
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-bsf:v",
+            "h264_mp4toannexb",
+            "-frames:v",
+            "1",
+            "-f",
+            "h264",
+            "-",
+        ]
+    )
+    headers = [
+        nal.rstrip(b"\x00")
+        for nal in result.stdout.split(b"\x00\x00\x01")
+        if nal and nal[0] & 0x1F in (7, 8)
+    ]
+    return hashlib.md5(b"".join(headers)).hexdigest()
+
+
+def probe_keyframes(video_path: str) -> dict:
+    """
+    Keyframe times of the first video stream, only the keyframes are decoded,
+    and the hash of its headers (see probe_stream_headers).
+    """
+    result = run_ffmpeg(
+        [
+            "-skip_frame",
+            "nokey",
+            "-i",
+            video_path,
+            "-map",
+            "0:v:0",
+            "-vf",
+            "showinfo",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+    output = result.stderr.decode("utf-8", errors="ignore")
+    keyframes = [
+        round(float(t), 6) for t in re.findall(r"pts_time:\s*(-?[\d.]+)", output)
+    ]
+    return {
+        "keyframes": keyframes,
+        "stream_headers": probe_stream_headers(video_path),
+    }
+
+
+def get_keyframe_info(video_path: str) -> dict:
+    """
+    get_video_info plus the keyframes and the header hash of probe_keyframes,
+    probed once and kept in the same sidecar. Only valid for h264 sources.
+    """
+    info = get_video_info(video_path)
+    if "keyframes" not in info:
+        info = {**info, **probe_keyframes(video_path)}
+        save_video_info(video_path, info)
+    return info
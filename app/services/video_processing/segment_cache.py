@@ -0,0 +1,83 @@
+import json
+import os
+from dataclasses import asdict
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.models.timeline import Timeline, TimelineClip
+from app.utils import utils
+
+
+def _max_size() -> int:
+    return int(config.app.get("segment_cache_max_size_mb", 5120)) * 1024 * 1024
+
+
+def is_enabled() -> bool:
+    return _max_size() > 0
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("cache_segments", create=True)
+
+
+def get_key(
+    timeline: Timeline,
+    clip: TimelineClip,
+    subtitle_images: List[dict],
+    encoding: dict,
+    renderer: str,
+) -> str:
+    """
+    Hash of everything that ends up in the pixels of a segment: the source
+    file and slice, the geometry and transition, the subtitle sprites over it
+    (their file names are content hashes) and the encoder settings.
+    """
+    try:
+        stat = os.stat(clip.path)
+        source = [stat.st_size, stat.st_mtime]
+    except OSError:
+        source = []
+    data = {
+        "renderer": renderer,
+        "format": [timeline.width, timeline.height, timeline.fps],
+        "clip": asdict(clip),
+        "source": source,
+        "subtitles": [
+            [
+                os.path.basename(image["path"]),
+                round(image["start"], 3),
+                round(image["end"], 3),
+                int(image["x"]),
+                int(image["y"]),
+            ]
+            for image in subtitle_images or []
+        ],
+        "encoding": {k: v for k, v in (encoding or {}).items() if k != "name"},
+    }
+    return utils.md5(json.dumps(data, sort_keys=True, default=str))
+
+
+def get(key: str) -> str:
+    segment_file = os.path.join(cache_dir(), f"{key}.mp4")
+    if os.path.isfile(segment_file) and os.path.getsize(segment_file) > 0:
+        utils.touch_file(segment_file)
+        return segment_file
+    return ""
+
+
+def put(rendered_file: str, key: str) -> str:
+    """Move a freshly rendered segment into the cache, returns its cached path"""
+    segment_file = os.path.join(cache_dir(), f"{key}.mp4")
+    os.replace(rendered_file, segment_file)
+    return segment_file
+
+
+def evict():
+    utils.evict_lru_files(cache_dir(), _max_size(), suffix=".mp4")
+
+
+def log_stats(hits: int, total: int):
+    if total:
+        logger.info(f"segment cache: {hits}/{total} segments reused")
@@ -1,8 +1,13 @@
 import asyncio
+import json
 import os
 import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Union
+from functools import lru_cache
+from typing import Callable, List, Union
 from xml.sax.saxutils import unescape
 
 import edge_tts
@@ -12,13 +17,12 @@ from loguru import logger
 from moviepy.video.tools import subtitles
 
 from app.config import config
+from app.models import const
 from app.utils import utils
 
 
-def get_all_azure_voices(filter_locals=None) -> list[str]:
-    if filter_locals is None:
-        filter_locals = ["zh-CN", "en-US", "zh-HK", "zh-TW", "vi-VN"]
-    voices_str = """
+# every supported voice, parsed once into an index by _get_voice_catalog
+_VOICES_STR = """
 Name: af-ZA-AdriNeural
 Gender: Female
 
@@ -1013,30 +1017,80 @@ Gender: Female
 Name: zh-CN-XiaoxiaoMultilingualNeural-V2
 Gender: Female
     """.strip()
-    voices = []
+
+
+@lru_cache(maxsize=1)
+def _get_voice_catalog() -> dict:
+    """
+    Parse _VOICES_STR once. "names" maps a voice name to its gender, "index"
+    maps (locale or language, gender, v2) to the sorted "<name>-<gender>"
+    entries, "" / None in the key match any gender / version.
+    """
+    names = {}
     name = ""
-    for line in voices_str.split("\n"):
+    for line in _VOICES_STR.split("\n"):
         line = line.strip()
-        if not line:
-            continue
         if line.startswith("Name: "):
             name = line[6:].strip()
-        if line.startswith("Gender: "):
-            gender = line[8:].strip()
-            if name and gender:
-                # voices.append({
-                #     "name": name,
-                #     "gender": gender,
-                # })
-                if filter_locals:
-                    for filter_local in filter_locals:
-                        if name.lower().startswith(filter_local.lower()):
-                            voices.append(f"{name}-{gender}")
-                else:
-                    voices.append(f"{name}-{gender}")
-                name = ""
-    voices.sort()
-    return voices
+        elif line.startswith("Gender: ") and name:
+            names[name] = line[8:].strip()
+            name = ""
+
+    index = {}
+    for name, gender in names.items():
+        locale = "-".join(name.split("-")[:2]).lower()
+        language = locale.split("-")[0]
+        v2 = name.endswith("-V2")
+        for area in ("", language, locale):
+            for key_gender in ("", gender.lower()):
+                for key_v2 in (None, v2):
+                    index.setdefault((area, key_gender, key_v2), []).append(
+                        f"{name}-{gender}"
+                    )
+    for voices in index.values():
+        voices.sort()
+    return {"names": names, "index": index}
+
+
+def get_voices(locale: str = "", gender: str = "", v2: bool = None) -> List[str]:
+    """
+    Voices of a locale ("zh-CN") or a language ("zh"), optionally of one
+    gender ("Female" / "Male") and only V1 or V2 voices, as "<name>-<gender>".
+    """
+    key = (locale.lower(), gender.lower(), v2)
+    return list(_get_voice_catalog()["index"].get(key, []))
+
+
+@lru_cache(maxsize=32)
+def _filter_voices(filter_locals: tuple) -> tuple:
+    if not filter_locals:
+        return tuple(get_voices())
+    voices = set()
+    index = _get_voice_catalog()["index"]
+    for filter_local in filter_locals:
+        key = (filter_local.lower(), "", None)
+        if key in index:
+            voices.update(index[key])
+        else:
+            # not a locale or a language, match the voice names by prefix
+            voices.update(
+                voice
+                for voice in index[("", "", None)]
+                if voice.lower().startswith(filter_local.lower())
+            )
+    return tuple(sorted(voices))
+
+
+def get_all_azure_voices(filter_locals=None) -> list[str]:
+    if filter_locals is None:
+        filter_locals = ["zh-CN", "en-US", "zh-HK", "zh-TW", "vi-VN"]
+    return list(_filter_voices(tuple(filter_locals)))
+
+
+def is_valid_voice(voice_name: str) -> bool:
+    """True for a known voice, with or without the gender suffix"""
+    voice_name = parse_voice_name(voice_name or "")
+    return voice_name in _get_voice_catalog()["names"]
 
 
 def parse_voice_name(name: str):
@@ -1054,12 +1108,108 @@ def is_azure_v2_voice(voice_name: str):
     return ""
 
 
+_tts_stats = {"hits": 0, "misses": 0}
+_tts_stats_lock = threading.Lock()
+# word boundaries are stored next to the cached mp3
+_SUBS_SUFFIX = ".subs.json"
+
+
+def get_tts_cache_stats() -> dict:
+    with _tts_stats_lock:
+        stats = dict(_tts_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 3) if total else 0.0
+    return stats
+
+
+def _tts_cache_max_size() -> int:
+    return int(config.app.get("tts_cache_max_size_mb", 1024)) * 1024 * 1024
+
+
+def _tts_cache_file(text: str, voice_name: str, voice_rate: float) -> str:
+    voice_name = parse_voice_name(voice_name)
+    # azure v2 voices are always synthesized at the normal rate
+    if is_azure_v2_voice(voice_name):
+        voice_rate = 1.0
+    key = utils.md5(
+        json.dumps([" ".join(text.split()), voice_name, round(float(voice_rate), 2)])
+    )
+    return os.path.join(utils.storage_dir("cache_tts", create=True), f"{key}.mp3")
+
+
+def _load_cached_tts(cache_file: str, voice_file: str) -> Union[SubMaker, None]:
+    if not os.path.isfile(cache_file) or not os.path.isfile(
+        f"{cache_file}{_SUBS_SUFFIX}"
+    ):
+        return None
+    try:
+        with open(f"{cache_file}{_SUBS_SUFFIX}", "r", encoding="utf-8") as f:
+            data = json.load(f)
+        sub_maker = SubMaker()
+        sub_maker.subs = data["subs"]
+        sub_maker.offset = [tuple(offset) for offset in data["offset"]]
+        shutil.copyfile(cache_file, voice_file)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"invalid tts cache file: {cache_file} => {str(e)}")
+        return None
+    utils.touch_file(cache_file)
+    return sub_maker
+
+
+def _save_cached_tts(cache_file: str, voice_file: str, sub_maker: SubMaker):
+    temp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+    try:
+        with open(f"{cache_file}{_SUBS_SUFFIX}", "w", encoding="utf-8") as f:
+            json.dump({"subs": sub_maker.subs, "offset": sub_maker.offset}, f)
+        shutil.copyfile(voice_file, temp_file)
+        os.replace(temp_file, cache_file)
+    except OSError as e:
+        logger.warning(f"failed to cache tts audio: {str(e)}")
+        return
+    utils.evict_lru_files(
+        os.path.dirname(cache_file),
+        _tts_cache_max_size(),
+        suffix=".mp3",
+        sidecar_suffix=_SUBS_SUFFIX,
+    )
+
+
 def tts(
-    text: str, voice_name: str, voice_rate: float, voice_file: str
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    progress: Callable[[dict], None] = None,
 ) -> Union[SubMaker, None]:
+    """
+    Synthesize text into voice_file. The audio and its word boundaries are
+    cached by text, voice and rate, so the same speech is only synthesized once.
+    progress receives the streaming progress of edge-tts, see azure_tts_v1.
+    """
+    if not is_valid_voice(voice_name):
+        logger.error(f"unknown voice name: {voice_name}")
+        return None
+
+    use_cache = _tts_cache_max_size() > 0
+    if use_cache:
+        cache_file = _tts_cache_file(text, voice_name, voice_rate)
+        sub_maker = _load_cached_tts(cache_file, voice_file)
+        with _tts_stats_lock:
+            _tts_stats["hits" if sub_maker else "misses"] += 1
+        if sub_maker:
+            logger.info(f"tts audio from cache: {cache_file}")
+            return sub_maker
+
     if is_azure_v2_voice(voice_name):
-        return azure_tts_v2(text, voice_name, voice_file)
-    return azure_tts_v1(text, voice_name, voice_rate, voice_file)
+        sub_maker = azure_tts_v2(text, voice_name, voice_file)
+    else:
+        sub_maker = azure_tts_v1(
+            text, voice_name, voice_rate, voice_file, progress=progress
+        )
+
+    if use_cache and sub_maker and sub_maker.subs:
+        _save_cached_tts(cache_file, voice_file, sub_maker)
+    return sub_maker
 
 
 def convert_rate_to_percent(rate: float) -> str:
@@ -1072,39 +1222,175 @@ def convert_rate_to_percent(rate: float) -> str:
         return f"{percent}%"
 
 
+# edge-tts always streams audio-24khz-48kbitrate-mono-mp3, a constant bitrate,
+# so the duration of a chunk follows from its size
+_EDGE_TTS_BYTES_PER_SECOND = 48000 // 8
+
+# created on the shared event loop (utils.run_async), bounds the edge-tts
+# connections of all the tasks together
+_tts_semaphore = None
+
+
+def _get_tts_semaphore() -> asyncio.Semaphore:
+    global _tts_semaphore
+    if _tts_semaphore is None:
+        workers = max(1, int(config.app.get("tts_workers", 4)))
+        _tts_semaphore = asyncio.Semaphore(workers)
+    return _tts_semaphore
+
+
+def _split_tts_chunks(text: str, max_chars: int) -> List[str]:
+    """
+    Split text into chunks of about max_chars at the sentence boundaries of
+    utils.split_string_by_punctuations, keeping the punctuation in the text.
+    """
+    if max_chars <= 0 or len(text) <= max_chars:
+        return [text]
+
+    boundaries = []
+    position = 0
+    for sentence in utils.split_string_by_punctuations(text):
+        index = text.find(sentence, position)
+        if index < 0:
+            continue
+        end = index + len(sentence)
+        while end < len(text) and text[end] in const.PUNCTUATIONS:
+            end += 1
+        boundaries.append(end)
+        position = end
+
+    chunks = []
+    start = last = 0
+    for end in boundaries:
+        if end - start > max_chars and last > start:
+            chunks.append(text[start:last])
+            start = last
+        last = end
+    chunks.append(text[start:])
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def _spoken_chars(text: str) -> int:
+    return len(re.sub(r"[\W_]+", "", text))
+
+
 def azure_tts_v1(
-    text: str, voice_name: str, voice_rate: float, voice_file: str
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    progress: Callable[[dict], None] = None,
 ) -> Union[SubMaker, None]:
+    """
+    Long scripts are synthesized in sentence aligned chunks, concurrently,
+    and a failed chunk is retried on its own. Every chunk streams into its
+    own part file, the parts are joined into voice_file with their word
+    boundaries shifted onto one timeline.
+
+    progress is called with the bytes and the seconds of speech received so
+    far, and the duration projected from the speech rate seen so far. It runs
+    on a thread of its own, in order, never on the shared event loop.
+    """
     voice_name = parse_voice_name(voice_name)
     text = text.strip()
     rate_str = convert_rate_to_percent(voice_rate)
-    for i in range(3):
+    chunks = _split_tts_chunks(text, int(config.app.get("tts_chunk_size", 600)))
+    logger.info(f"start, voice name: {voice_name}, chunks: {len(chunks)}")
+
+    total_chars = _spoken_chars(text)
+    received = [{"bytes": 0, "offset": 0, "chars": 0} for _ in chunks]
+    # the callback may block (task state in redis), keep it off the event loop
+    reporter = ThreadPoolExecutor(max_workers=1) if progress else None
+
+    def _call_progress(data: dict):
         try:
-            logger.info(f"start, voice name: {voice_name}, try: {i + 1}")
+            progress(data)
+        except Exception as e:
+            logger.warning(f"tts progress callback failed: {str(e)}")
+
+    def _report():
+        if not progress:
+            return
+        chars = sum(r["chars"] for r in received)
+        # offsets are in 100 nanosecond ticks
+        seconds = sum(r["offset"] for r in received) / 10000000
+        if chars:
+            estimated_duration = seconds * max(total_chars, chars) / chars
+        else:
+            estimated_duration = estimate_duration(text, voice_rate)
+        reporter.submit(
+            _call_progress,
+            {
+                "bytes": sum(r["bytes"] for r in received),
+                "seconds": seconds,
+                "chars": chars,
+                "total_chars": total_chars,
+                "estimated_duration": estimated_duration,
+            },
+        )
+
+    async def _synthesize(index: int, chunk: str, semaphore: asyncio.Semaphore):
+        part_file = f"{voice_file}.{index + 1}.part"
+        async with semaphore:
+            for i in range(3):
+                received[index] = {"bytes": 0, "offset": 0, "chars": 0}
+                try:
+                    communicate = edge_tts.Communicate(chunk, voice_name, rate=rate_str)
+                    boundaries = []
+                    with open(part_file, "wb") as file:
+                        async for item in communicate.stream():
+                            if item["type"] == "audio":
+                                file.write(item["data"])
+                                received[index]["bytes"] += len(item["data"])
+                            elif item["type"] == "WordBoundary":
+                                boundaries.append(
+                                    (item["offset"], item["duration"], item["text"])
+                                )
+                                received[index]["offset"] = (
+                                    item["offset"] + item["duration"]
+                                )
+                                received[index]["chars"] += _spoken_chars(item["text"])
+                                _report()
+                    if received[index]["bytes"] and boundaries:
+                        return part_file, received[index]["bytes"], boundaries
+                    logger.warning(
+                        f"failed, chunk {index + 1} has no word boundaries, try: {i + 1}"
+                    )
+                except Exception as e:
+                    logger.error(f"failed, chunk {index + 1}, try: {i + 1}, error: {str(e)}")
+        return None
 
-            async def _do() -> SubMaker:
-                communicate = edge_tts.Communicate(text, voice_name, rate=rate_str)
-                sub_maker = edge_tts.SubMaker()
-                with open(voice_file, "wb") as file:
-                    async for chunk in communicate.stream():
-                        if chunk["type"] == "audio":
-                            file.write(chunk["data"])
-                        elif chunk["type"] == "WordBoundary":
-                            sub_maker.create_sub(
-                                (chunk["offset"], chunk["duration"]), chunk["text"]
-                            )
-                return sub_maker
+    async def _do():
+        semaphore = _get_tts_semaphore()
+        return await asyncio.gather(
+            *[_synthesize(i, chunk, semaphore) for i, chunk in enumerate(chunks)]
+        )
 
-            sub_maker = asyncio.run(_do())
-            if not sub_maker or not sub_maker.subs:
-                logger.warning("failed, sub_maker is None or sub_maker.subs is None")
-                continue
+    _report()
+    try:
+        results = utils.run_async(_do())
+        if not results or any(result is None for result in results):
+            return None
+
+        sub_maker = edge_tts.SubMaker()
+        chunk_start = 0
+        with open(voice_file, "wb") as file:
+            for part_file, size, boundaries in results:
+                with open(part_file, "rb") as part:
+                    shutil.copyfileobj(part, file)
+                for offset, duration, word in boundaries:
+                    sub_maker.create_sub((chunk_start + offset, duration), word)
+                chunk_start += size * 10000000 // _EDGE_TTS_BYTES_PER_SECOND
+    finally:
+        if reporter:
+            reporter.shutdown(wait=True)
+        for index in range(len(chunks)):
+            part_file = f"{voice_file}.{index + 1}.part"
+            if os.path.exists(part_file):
+                os.remove(part_file)
 
-            logger.info(f"completed, output file: {voice_file}")
-            return sub_maker
-        except Exception as e:
-            logger.error(f"failed, error: {str(e)}")
-    return None
+    logger.info(f"completed, output file: {voice_file}")
+    return sub_maker
 
 
 def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> Union[SubMaker, None]:
@@ -1300,6 +1586,23 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
         logger.error(f"failed, error: {str(e)}")
 
 
+# average speaking rate of the neural voices at rate 1.0, CJK characters are
+# syllables, other scripts are counted in characters including spaces
+_CJK_CHARS_PER_SECOND = 4.5
+_CHARS_PER_SECOND = 15.0
+
+
+def estimate_duration(text: str, voice_rate: float = 1.0) -> float:
+    """
+    Estimated duration of the speech of text in seconds, for planning work
+    that can start before the TTS has finished.
+    """
+    cjk = len(re.findall(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]", text))
+    other = len(re.sub(r"\s+", " ", text).strip()) - cjk
+    seconds = cjk / _CJK_CHARS_PER_SECOND + max(other, 0) / _CHARS_PER_SECOND
+    return seconds / (voice_rate or 1.0)
+
+
 def get_audio_duration(sub_maker: submaker.SubMaker):
     """
     获取音频时长
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import locale
 import os
@@ -72,7 +73,8 @@ def storage_dir(sub_dir: str = "", create: bool = False):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if create and not os.path.exists(d):
-        os.makedirs(d)
+        # variants rendered concurrently can create the same cache dir
+        os.makedirs(d, exist_ok=True)
 
     return d
 
@@ -197,12 +199,90 @@ def split_string_by_punctuations(s):
     return result
 
 
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    A long lived event loop on a daemon thread, shared by the sync pipeline
+    instead of creating and closing a loop with asyncio.run for every call.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None or _event_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="async-loop", daemon=True
+            ).start()
+            _event_loop = loop
+        return _event_loop
+
+
+def run_async(coro, timeout: float = None):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    loop = get_event_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        coro.close()
+        raise RuntimeError("run_async can not be called from the shared event loop")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
 def md5(text):
     import hashlib
 
     return hashlib.md5(text.encode("utf-8")).hexdigest()
 
 
+def touch_file(file_path: str):
+    """Mark a cached file as recently used, see evict_lru_files"""
+    try:
+        os.utime(file_path, None)
+    except OSError:
+        pass
+
+
+def evict_lru_files(
+    directory: str, max_size: int, suffix: str = "", sidecar_suffix: str = ""
+):
+    """
+    Delete the least recently used files (by mtime) in directory until the
+    total size is within max_size bytes. With sidecar_suffix, the
+    <file><sidecar_suffix> of an evicted file is deleted with it.
+    """
+    if max_size <= 0 or not os.path.isdir(directory):
+        return
+
+    files = []
+    total_size = 0
+    for entry in os.scandir(directory):
+        if not entry.is_file() or (suffix and not entry.name.endswith(suffix)):
+            continue
+        stat = entry.stat()
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size += stat.st_size
+
+    if total_size <= max_size:
+        return
+
+    files.sort()
+    for _, size, file_path in files:
+        try:
+            os.remove(file_path)
+            total_size -= size
+            logger.info(f"evicted cache file: {file_path}")
+            if sidecar_suffix and os.path.exists(f"{file_path}{sidecar_suffix}"):
+                os.remove(f"{file_path}{sidecar_suffix}")
+        except OSError:
+            continue
+        if total_size <= max_size:
+            break
+
+
 def get_system_locale():
     try:
         loc = locale.getdefaultlocale()